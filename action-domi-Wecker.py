@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import paho.mqtt.client as mqtt
 import json
+import time
 from alarmclock.alarmclock import AlarmClock
+from alarmclock.aio import AsyncioMqttAdapter, run_coroutine_handler
+from alarmclock.metrics import Metrics
+from alarmclock.router import IntentRouter
 import alarmclock.utils
 import toml
 
+# start of the app for the startupTime in 'external/alarmclock/ready'
+start_time = time.time()
+
 USERNAME_INTENTS = "domi"
 MQTT_BROKER_ADDRESS = "localhost:1883"
 MQTT_USERNAME = None
@@ -17,73 +25,72 @@ def add_prefix(intent_name):
     return USERNAME_INTENTS + ":" + intent_name
 
 
-def get_slots(data):
-    slot_dict = {}
-    try:
-        for slot in data['slots']:
-            if slot['value']['kind'] in ["InstantTime", "TimeInterval", "Duration"]:
-                slot_dict[slot['slotName']] = slot['value']
-            elif slot['value']['kind'] == "Custom":
-                slot_dict[slot['slotName']] = slot['value']['value']
-    except (KeyError, TypeError, ValueError) as e:
-        print("Error: ", e)
-        slot_dict = {}
-    return slot_dict
+def on_new_alarm(data, slots):
+    # create new alarm with the given properties
+    return say(data['sessionId'], alarmclock.new_alarm(slots, data['siteId']))
 
 
-def on_message_intent(client, userdata, msg):
-    data = json.loads(msg.payload.decode("utf-8"))
-    session_id = data['sessionId']
-    intent_id = data['intent']['intentName']
-
-    if intent_id == add_prefix('newAlarm'):
-        # create new alarm with the given properties
-        slots = get_slots(data)
-        say(session_id, alarmclock.new_alarm(slots, data['siteId']))
-
-    elif intent_id == add_prefix('getAlarms'):
-        # say alarms with the given properties
-        slots = get_slots(data)
-        say(session_id, alarmclock.get_alarms(slots, data['siteId']))
-
-    elif intent_id == add_prefix('getNextAlarm'):
-        # say next alarm
-        slots = get_slots(data)
-        say(session_id, alarmclock.get_next_alarm(slots, data['siteId']))
-
-    elif intent_id == add_prefix('getMissedAlarms'):
-        # say missed alarms with the given properties
-        slots = get_slots(data)
-        say(session_id, alarmclock.get_missed_alarms(slots, data['siteId']))
-
-    elif intent_id == add_prefix('deleteAlarms'):
-        # delete alarms with the given properties
-        slots = get_slots(data)
-        alarms, response = alarmclock.delete_alarms_try(slots, data['siteId'])
-        if alarms:
-            custom_data = {'past_intent': intent_id,
-                           'siteId': data['siteId'],
-                           'slots': slots}
-            dialogue(session_id, response, [add_prefix('confirmAlarm')], custom_data=custom_data)
+def on_get_alarms(data, slots):
+    # say alarms with the given properties
+    return say(data['sessionId'], alarmclock.get_alarms(slots, data['siteId']))
+
+
+def on_get_next_alarm(data, slots):
+    # say next alarm
+    return say(data['sessionId'], alarmclock.get_next_alarm(slots, data['siteId']))
+
+
+def on_get_missed_alarms(data, slots):
+    # say missed alarms with the given properties
+    return say(data['sessionId'], alarmclock.get_missed_alarms(slots, data['siteId']))
+
+
+def on_delete_alarms(data, slots):
+    # delete alarms with the given properties
+    alarms, response = alarmclock.delete_alarms_try(slots, data['siteId'])
+    if alarms:
+        custom_data = {'past_intent': data['intent']['intentName'],
+                       'siteId': data['siteId'],
+                       'slots': slots}
+        return dialogue(data['sessionId'], response, [add_prefix('confirmAlarm')], custom_data=custom_data)
+    else:
+        return say(data['sessionId'], response)
+
+
+def on_confirm_alarm(data, slots):
+    custom_data = json.loads(data['customData'])
+    if custom_data and 'past_intent' in custom_data.keys():
+        if 'answer' in slots.keys() and \
+                slots['answer'] == "yes" and \
+                custom_data['past_intent'] == add_prefix('deleteAlarms'):
+            response = alarmclock.delete_alarms(custom_data['slots'], custom_data['siteId'])
+            messages = say(data['sessionId'], response)
         else:
-            say(session_id, response)
-
-    elif intent_id == add_prefix('confirmAlarm'):
-        custom_data = json.loads(data['customData'])
-        if custom_data and 'past_intent' in custom_data.keys():
-            slots = get_slots(data)
-            if 'answer' in slots.keys() and \
-                    slots['answer'] == "yes" and \
-                    custom_data['past_intent'] == add_prefix('deleteAlarms'):
-                response = alarmclock.delete_alarms(custom_data['slots'], custom_data['siteId'])
-                say(session_id, response)
-            else:
-                end_session(session_id)
-            alarmclock.temp_memory[data['siteId']] = None
-
-    elif intent_id == add_prefix('answerAlarm'):
-        slots = get_slots(data)
-        say(session_id, alarmclock.answer_alarm(slots, data['siteId']))
+            messages = end_session(data['sessionId'])
+        alarmclock.temp_memory[data['siteId']] = None
+        return messages
+
+
+def on_answer_alarm(data, slots):
+    return say(data['sessionId'], alarmclock.answer_alarm(slots, data['siteId']))
+
+
+def register_intents(router):
+    router.register('newAlarm', on_new_alarm)
+    router.register('getAlarms', on_get_alarms)
+    router.register('getNextAlarm', on_get_next_alarm)
+    router.register('getMissedAlarms', on_get_missed_alarms)
+    router.register('deleteAlarms', on_delete_alarms)
+    router.register('confirmAlarm', on_confirm_alarm)
+    router.register('answerAlarm', on_answer_alarm)
+
+
+def on_message_intent(client, userdata, msg):
+    intent_router.on_message_intent(client, userdata, msg)
+
+
+async def on_message_intent_async(client, userdata, msg):
+    on_message_intent(client, userdata, msg)
 
 
 def on_session_ended(client, userdata, msg):
@@ -93,7 +100,11 @@ def on_session_ended(client, userdata, msg):
             data['termination']['reason'] != "nominal":
         # if session was ended while confirmation process clean the past intent memory
         alarmclock.temp_memory[data['siteId']] = None
-        
+
+
+async def on_session_ended_async(client, userdata, msg):
+    on_session_ended(client, userdata, msg)
+
 
 def on_message_nlu_error(self, client, userdata, msg):
     # TODO
@@ -105,13 +116,13 @@ def on_message_nlu_error(self, client, userdata, msg):
     self.mqtt_client.publish('hermes/dialogueManager/endSession', payload)
 
 
+# The following functions return the messages for the intent router, which publishes them.
 def say(session_id, text):
-    mqtt_client.publish('hermes/dialogueManager/endSession', json.dumps({'text': text,
-                                                                         'sessionId': session_id}))
+    return [('hermes/dialogueManager/endSession', {'text': text, 'sessionId': session_id})]
 
 
 def end_session(session_id):
-    mqtt_client.publish('hermes/dialogueManager/endSession', json.dumps({'sessionId': session_id}))
+    return [('hermes/dialogueManager/endSession', {'sessionId': session_id})]
 
 
 def dialogue(session_id, text, intent_filter, custom_data=None):
@@ -120,7 +131,58 @@ def dialogue(session_id, text, intent_filter, custom_data=None):
             'intentFilter': intent_filter}
     if custom_data:
         data['customData'] = json.dumps(custom_data)
-    mqtt_client.publish('hermes/dialogueManager/continueSession', json.dumps(data))
+    return [('hermes/dialogueManager/continueSession', data)]
+
+
+def connect():
+    mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    mqtt_client.connect(MQTT_BROKER_ADDRESS.split(":")[0], int(MQTT_BROKER_ADDRESS.split(":")[1]))
+
+
+def subscribe():
+    # only the intents of this app instead of 'hermes/intent/#'
+    subscriptions = alarmclock.alarmctl.subscriptions
+    for topic in intent_router.get_topics():
+        subscriptions.add(topic)
+    subscriptions.add('hermes/dialogueManager/sessionEnded')
+    subscriptions.add('external/alarmclock/getIntentStats')
+    mqtt_client.on_connect = on_connect
+
+
+def on_connect(client, userdata, flags, rc):
+    alarmclock.alarmctl.subscriptions.resubscribe()
+
+
+def main_threads(config):
+    global alarmclock
+    mqtt_client.message_callback_add('hermes/intent/#', on_message_intent)
+    mqtt_client.message_callback_add('hermes/dialogueManager/sessionEnded', on_session_ended)
+    connect()
+    alarmclock = AlarmClock(mqtt_client, start_time, config, metrics=metrics)
+    subscribe()
+    alarmclock.publish_ready()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        alarmclock.alarmctl.flush()
+
+
+async def main_asyncio(config):
+    # one event loop for MQTT, intent handlers, alarms, ringing timeouts and saving
+    global alarmclock
+    loop = asyncio.get_running_loop()
+    AsyncioMqttAdapter(loop, mqtt_client)
+    mqtt_client.message_callback_add('hermes/intent/#', run_coroutine_handler(loop, on_message_intent_async))
+    mqtt_client.message_callback_add('hermes/dialogueManager/sessionEnded',
+                                     run_coroutine_handler(loop, on_session_ended_async))
+    connect()
+    alarmclock = AlarmClock(mqtt_client, start_time, config, loop, metrics=metrics)
+    subscribe()
+    alarmclock.publish_ready()
+    try:
+        await loop.create_future()  # run forever
+    finally:
+        await alarmclock.alarmctl.writer.drain()
 
 
 if __name__ == "__main__":
@@ -132,12 +194,13 @@ if __name__ == "__main__":
     if 'mqtt_password' in snips_config['snips-common'].keys():
         MQTT_PASSWORD = snips_config['snips-common']['mqtt_password']
 
+    skill_config = alarmclock.utils.get_config("config.ini", "config.ini.default")
     mqtt_client = mqtt.Client()
-    mqtt_client.message_callback_add('hermes/intent/#', on_message_intent)
-    mqtt_client.message_callback_add('hermes/dialogueManager/sessionEnded', on_session_ended)
-    mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    mqtt_client.connect(MQTT_BROKER_ADDRESS.split(":")[0], int(MQTT_BROKER_ADDRESS.split(":")[1]))
-    mqtt_client.subscribe('hermes/intent/#')
-    mqtt_client.subscribe('hermes/dialogueManager/sessionEnded')
-    alarmclock = AlarmClock(mqtt_client)
-    mqtt_client.loop_forever()
+    metrics = Metrics()
+    intent_router = IntentRouter(mqtt_client, USERNAME_INTENTS, metrics)
+    register_intents(intent_router)
+    mqtt_client.message_callback_add('external/alarmclock/getIntentStats', intent_router.on_message_getstats)
+    if skill_config['runtime'] == "asyncio":
+        asyncio.run(main_asyncio(skill_config))
+    else:
+        main_threads(skill_config)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import paho.mqtt.client as mqtt
+
+
+class AsyncioMqttAdapter:
+    def __init__(self, loop, mqtt_client, reconnect_delay=5):
+
+        """
+        Runs the network loop of a paho client in an asyncio event loop instead of loop_forever().
+        All MQTT callbacks are then called in the event loop. Must be created before connect().
+        :param loop: asyncio event loop
+        :param mqtt_client: MQTT client object (from paho)
+        :param reconnect_delay: Seconds to wait before reconnecting after the connection was lost
+        """
+
+        self.loop = loop
+        self.mqtt_client = mqtt_client
+        self.reconnect_delay = reconnect_delay
+        self.misc_task = None
+        self.mqtt_client.on_socket_open = self.on_socket_open
+        self.mqtt_client.on_socket_close = self.on_socket_close
+        self.mqtt_client.on_socket_register_write = self.on_socket_register_write
+        self.mqtt_client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # keepalive pings and retries, like loop_forever() does it
+        while self.mqtt_client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+        self.loop.call_later(self.reconnect_delay, self.reconnect)
+
+    def reconnect(self):
+        try:
+            self.mqtt_client.reconnect()
+        except (OSError, ConnectionError) as e:
+            print("Error while reconnecting to MQTT broker: ", e)
+            self.loop.call_later(self.reconnect_delay, self.reconnect)
+
+
+def run_coroutine_handler(loop, coroutine_function):
+
+    """
+    Wraps a coroutine function as paho callback. Every message starts a new task in the event loop.
+    :param loop: asyncio event loop
+    :param coroutine_function: Coroutine function with the paho callback parameters (client, userdata, msg)
+    :return: Callback function for paho
+    """
+
+    def callback(client, userdata, msg):
+        loop.create_task(coroutine_function(client, userdata, msg))
+    return callback
@@ -1,30 +1,79 @@
 import io
+import os
 import json
 import datetime
+from . import clock
 from . import formattime as ftime
 import threading
-import time
 import uuid
-import functools                     # functools.partial for threading.Timeout callback with parameter
-from . import utils
+import functools                     # functools.partial for timer callbacks with parameter
+from concurrent.futures import ThreadPoolExecutor
+from . alarmindex import AlarmIndex, MissedAlarmArchive
+from . changefeed import ChangeFeed, GET_SNAPSHOT_TOPIC
+from . journal import AlarmJournal
+from . metrics import Metrics
+from . ringtone import RingtoneStore
+from . scheduler import AlarmScheduler, TimerService, AsyncTimerService
+from . sqlitestore import SqliteAlarmStore
+from . subscriptions import SubscriptionManager
+from . writer import PersistenceWriter, AsyncPersistenceWriter
 from . translation import Translation
 
 
+# states of a site: idle -> ringing -> awaiting-session (hotword was detected) -> idle or snoozed,
+# snoozed -> ringing (the snooze alarm is due) or idle (the snooze alarm was changed or deleted)
+STATE_IDLE = "idle"
+STATE_RINGING = "ringing"
+STATE_AWAITING_SESSION = "awaiting-session"
+STATE_SNOOZED = "snoozed"
+
+
 class Site(object):
-    def __init__(self, siteid, room, ringtone_status, ringing_timeout, ringtone_wav):
+    def __init__(self, siteid, room, ringtone_status, ringing_timeout, ringing_volume, ringtone_profile,
+                 ringtone_wav=None):
         self.siteid = siteid
         self.room = room
         self.ringing_timeout = ringing_timeout
         self.ringtone_status = ringtone_status
-        self.ringtone_wav = ringtone_wav
+        self.ringing_volume = ringing_volume
+        self.ringtone_profile = ringtone_profile
+        self.ringtone_wav = ringtone_wav  # None until the ringtone was rendered
+        self.ringtone_chunks = None
+        self.chunk_index = 0
         self.ringing_alarm = None
-        self.ringtone_id = None
-        self.timeout_thread = None
-        self.session_pending = False
+        self.ringtone_ids = set()
+        # ringtone messages which were played since the site started ringing
+        self.played_count = 0
+        self.timer = None
+        self.state = STATE_IDLE
+        # the alarm which rings again after snoozing (state snoozed)
+        self.snooze_alarm = None
+
+
+# parameters which only take effect after a restart (the others are applied by apply_config)
+RESTART_PARAMS = ['alarms_storage', 'journal_fsync', 'journal_max_size', 'restore_alarms', 'ringtone_rendering',
+                  'runtime']
+# parameters which change the rendered ringtones of all sites
+RINGTONE_PARAMS = ['ringtone_loops', 'ringtone_chunk_size']
+
+# number of ringtone chunks which are sent ahead so the audio server never runs dry
+PREFETCH_CHUNKS = 1
+# seconds between two checks for missed alarms older than missed_alarms_max_age
+PRUNE_INTERVAL = 3600
+
+HOTWORD_DETECTED_TOPIC = 'hermes/hotword/+/detected'
+SESSION_STARTED_TOPIC = 'hermes/dialogueManager/sessionStarted'
+PLAY_FINISHED_TOPIC = 'hermes/audioServer/{site_id}/playFinished'
+PLAY_FINISHED_PATTERN = 'hermes/audioServer/+/playFinished'
+# seconds to wait for the session after the hotword stopped the ringing
+SESSION_TIMEOUT = 30
+BULK_TOPIC = 'external/alarmclock/bulk'
+NEXT_ALARM_TOPIC = 'external/alarmclock/{site_id}/next'
 
 
 class Alarm:
-    def __init__(self, datetime_obj=None, site=None, repetition=None, missed=False):
+    def __init__(self, datetime_obj=None, site=None, repetition=None, missed=False, alarm_id=None):
+        self.id = alarm_id or str(uuid.uuid4())
         self.datetime = datetime_obj
         self.repetition = repetition
         self.site = site
@@ -39,125 +88,468 @@ class Alarm:
         return datetime.datetime.strftime(self.datetime, str_format)
 
     def get_data_dict(self):
-        return {'datetime': self.get_datetime_str(),
+        return {'id': self.id,
+                'datetime': self.get_datetime_str(),
                 'siteid': self.site.siteid,
                 'room': self.site.room,
                 'repetition': self.repetition,
                 'missed': self.missed}
 
     def check_missed(self):
-        return (self.datetime - datetime.datetime.now()).days < 0
+        return (self.datetime - clock.now()).days < 0
 
 
 class AlarmControl:
-    def __init__(self, config, language, mqtt_client, temp_memory, alarms=None):
+    def __init__(self, config, language, mqtt_client, temp_memory, alarms=None, loop=None, metrics=None):
         self.config = config
+        # asyncio event loop (asyncio runtime) or None (threads)
+        self.loop = loop
+        self.metrics = metrics or Metrics()
+        self.mqtt_client = mqtt_client
+        # siteId -> last published payload of the next alarm of the site
+        self.next_alarms = {}
+        self.next_lock = threading.Lock()
+        # serialises the state changes of the sites (clock thread and MQTT thread)
+        self.state_lock = threading.RLock()
         self.saved_alarms_path = ".saved_alarms.json"
+        self.journal = None
+        # in sqlite mode every change is a transaction of the writer and the missed alarms are only kept in the store
+        self.store = None
+        if config['alarms_storage'] == "journal":
+            self.journal = AlarmJournal(".saved_alarms.journal", config['journal_fsync'], config['journal_max_size'])
+        elif config['alarms_storage'] == "sqlite":
+            self.store = SqliteAlarmStore(".saved_alarms.db", config['journal_fsync'])
+        if loop:
+            self.writer = AsyncPersistenceWriter(self.write_snapshot, self.journal or self.store, loop,
+                                                 metrics=self.metrics)
+        else:
+            self.writer = PersistenceWriter(self.write_snapshot, self.journal or self.store, metrics=self.metrics)
+        # every persisted change is also published as a delta with a sequence number
+        self.changes = ChangeFeed(mqtt_client, self.get_snapshot)
         self.sites_dict = {}
+        self.ringtone_store = RingtoneStore(".ringtone_cache")
+        self.render_pool = None
         for room, siteid in config['dict_siteids'].items():
-            ringtone_status = self.config['ringtone_status'][siteid]
-            ringing_timeout = self.config['ringing_timeout'][siteid]
-            ringing_volume = self.config['ringing_volume'][siteid]
-            ringtone_wav = utils.edit_volume("alarm-sound.wav", ringing_volume)
-            self.sites_dict[siteid] = Site(siteid, room, ringtone_status, ringing_timeout, ringtone_wav)
-        if alarms:
-            self.alarms = alarms
-        elif config['restore_alarms']:
-            self.alarms = self.restore()
+            self.sites_dict[siteid] = self.create_site(siteid, room)
+        if config['ringtone_rendering'] == "background":
+            self.render_pool = ThreadPoolExecutor(max_workers=4)
+        for site in self.sites_dict.values():
+            self.prepare_ringtone(site)
+        # alarm dictionaries of sites which aren't in the config (anymore), they are kept and saved until the
+        # site is configured again (in sqlite mode they just stay in the store)
+        self.orphaned_alarms = {}
+        if not alarms and config['restore_alarms']:
+            alarms = self.restore()
+        elif self.journal:
+            # the next compaction starts from these alarms instead of the old snapshot and journal
+            self.journal.reset([alarm.get_data_dict() for alarm in alarms or []])
+        # live alarms and missed alarms are kept in separate indexes sorted by datetime, the missed alarms
+        # in a bounded archive (in sqlite mode they are only kept in the store)
+        self.alarms = AlarmIndex(alarm for alarm in alarms or [] if not alarm.missed)
+        self.missed_alarms = MissedAlarmArchive(config['missed_alarms_max'], config['missed_alarms_max_age'],
+                                                (alarm for alarm in alarms or [] if alarm.missed))
+        self.save_changes('add', self.check_set_missed())
+        self.prune_missed()
+        # one timer service for alarms, snoozes, ringing timeouts and session expiries
+        if loop:
+            self.timers = AsyncTimerService(loop)
         else:
-            self.alarms = []
-        self.check_set_missed()
-        self.save()
-        self.clock_thread = threading.Thread(target=self.clock)
-        self.clock_thread.start()
+            self.timers = TimerService()
+        self.scheduler = AlarmScheduler(self.on_alarm_due, self.timers)
+        for alarm in self.get_alarms():
+            self.scheduler.add(alarm)
         self.translation = Translation(language)
         self.temp_memory = temp_memory
-        self.mqtt_client = mqtt_client
-        self.mqtt_client.message_callback_add('hermes/hotword/#', self.on_message_hotword)
+        for site in self.sites_dict.values():
+            self.update_next_alarm(site)
+        # Only exact topics are subscribed. Hotword, session and playFinished topics are only subscribed
+        # while a site needs them, so e.g. audio frames of the satellites never reach this app.
+        # The callbacks are registered once and dispatch to the site by its siteId.
+        self.subscriptions = SubscriptionManager(mqtt_client)
+        self.subscriptions.route(HOTWORD_DETECTED_TOPIC, self.on_message_hotword)
+        self.subscriptions.route(PLAY_FINISHED_PATTERN, self.on_message_playfinished)
+        self.subscriptions.route(SESSION_STARTED_TOPIC, self.on_message_sessionstarted)
         # TODO: Publish other messages over mqtt
-        self.mqtt_client.message_callback_add('external/alarmclock/stopRinging', self.on_message_stopringing)
-        self.mqtt_client.subscribe([('external/alarmclock/#', 0), ('hermes/dialogueManager/#', 0),
-                                    ('hermes/hotword/#', 0), ('hermes/audioServer/#', 0)])
+        self.subscriptions.route('external/alarmclock/stopRinging', self.on_message_stopringing)
+        self.subscriptions.add('external/alarmclock/stopRinging')
+        self.subscriptions.route(BULK_TOPIC, self.on_message_bulk)
+        self.subscriptions.add(BULK_TOPIC)
+        self.subscriptions.route(GET_SNAPSHOT_TOPIC, self.changes.on_message_getsnapshot)
+        self.subscriptions.add(GET_SNAPSHOT_TOPIC)
+        self.metrics_due = None
+        self.schedule_metrics()
+        self.timers.call_later(PRUNE_INTERVAL, self.prune_missed_periodically)
+        if loop:
+            self.timers.start()
+        else:
+            if not self.timers.clock.simulated:
+                self.clock_thread = threading.Thread(target=self.timers.run, daemon=True)
+                self.clock_thread.start()
+
+    def create_site(self, siteid, room):
+        return Site(siteid, room, self.config['ringtone_status'][siteid], self.config['ringing_timeout'][siteid],
+                    self.config['ringing_volume'][siteid], self.config['ringtone_profile'][siteid])
+
+    def apply_config(self, config):
+
+        """
+        Applies a changed config without a restart. Sites are added or removed, only the ringtones of sites
+        whose volume or encoding changed are rendered again and the alarms and ringing states of the other
+        sites are left untouched. The alarms of removed sites are kept (but don't ring) until the site is
+        configured again.
+        :param config: New config dictionary (see utils.get_config)
+        :return: Dictionary with the lists 'added', 'removed' and 'changed' of siteIds
+        """
+
+        for param in RESTART_PARAMS:
+            if config.get(param) != self.config.get(param):
+                print("Parameter '{}' of config only takes effect after a restart.".format(param))
+                config[param] = self.config[param]
+        rerender_all = any(config.get(param) != self.config.get(param) for param in RINGTONE_PARAMS)
+        old_config = dict(self.config)
+        # the dictionary is shared with AlarmClock and read by other threads, so it is changed in place
+        # without a moment in which a key is missing
+        self.config.update(config)
+        for param in set(self.config) - set(config):
+            del self.config[param]
+        changes = {'added': [], 'removed': [], 'changed': []}
+        siteids = {siteid: room for room, siteid in config['dict_siteids'].items()}
+        for siteid in list(self.sites_dict):
+            if siteid not in siteids:
+                self.remove_site(self.sites_dict[siteid])
+                changes['removed'].append(siteid)
+        for siteid, room in siteids.items():
+            if siteid not in self.sites_dict:
+                self.sites_dict[siteid] = self.create_site(siteid, room)
+                self.temp_memory.setdefault(siteid, None)
+                self.prepare_ringtone(self.sites_dict[siteid])
+                self.restore_site_alarms(self.sites_dict[siteid])
+                self.update_next_alarm(self.sites_dict[siteid])
+                changes['added'].append(siteid)
+                continue
+            site = self.sites_dict[siteid]
+            new_site = self.create_site(siteid, room)
+            if (site.room, site.ringtone_status, site.ringing_timeout) != \
+                    (new_site.room, new_site.ringtone_status, new_site.ringing_timeout):
+                # a running ringing timeout keeps its old duration
+                site.room = new_site.room
+                site.ringtone_status = new_site.ringtone_status
+                site.ringing_timeout = new_site.ringing_timeout
+                changes['changed'].append(siteid)
+                self.update_next_alarm(site)
+            if rerender_all or (site.ringing_volume, site.ringtone_profile) != \
+                    (new_site.ringing_volume, new_site.ringtone_profile):
+                site.ringing_volume = new_site.ringing_volume
+                site.ringtone_profile = new_site.ringtone_profile
+                self.prepare_ringtone(site, reload=True)
+                if siteid not in changes['changed']:
+                    changes['changed'].append(siteid)
+        if config['metrics_interval'] and not old_config['metrics_interval']:
+            self.schedule_metrics()
+        if (config['missed_alarms_max'], config['missed_alarms_max_age']) != \
+                (old_config['missed_alarms_max'], old_config['missed_alarms_max_age']):
+            # sqlite mode reads the limits from the config
+            self.missed_alarms.max_count = config['missed_alarms_max']
+            self.missed_alarms.max_age = config['missed_alarms_max_age']
+            self.prune_missed()
+        return changes
+
+    def remove_site(self, site):
+        with self.state_lock:
+            if site.state == STATE_RINGING:
+                self.stop_ringing(site)
+            elif site.state == STATE_AWAITING_SESSION:
+                site.timer.cancel()
+                site.timer = None
+                self.subscriptions.remove(SESSION_STARTED_TOPIC)
+            site.state = STATE_IDLE
+        removed = self.alarms.range(siteid=site.siteid) + self.missed_alarms.range(siteid=site.siteid)
+        self._remove_many(removed)
+        if not self.store:
+            # not deleted (e.g. the room was only removed by mistake), see restore_site_alarms
+            self.orphaned_alarms.setdefault(site.siteid, []).extend(alarm.get_data_dict() for alarm in removed)
+        del self.sites_dict[site.siteid]
+        self.temp_memory.pop(site.siteid, None)
+        self.update_next_alarm(site)
+
+    def restore_site_alarms(self, site):
+
+        """
+        Brings back the alarms of a site which was removed from the config and is configured again. Alarms
+        which were due in the meantime are missed.
+        :param site: The site object
+        :return: Nothing
+        """
+
+        if self.store:
+            alarm_dicts = self.store.query(siteid=site.siteid, missed=False, pending=self.writer.get_pending())
+        else:
+            alarm_dicts = self.orphaned_alarms.pop(site.siteid, [])
+        alarms = self.get_alarm_objects(alarm_dicts)
+        newly_missed = [alarm for alarm in alarms if not alarm.missed and alarm.check_missed()]
+        for alarm in newly_missed:
+            alarm.missed = True
+        live_alarms = [alarm for alarm in alarms if not alarm.missed]
+        self.alarms.update(added=live_alarms)
+        if not self.store:
+            self.missed_alarms.update(added=[alarm for alarm in alarms if alarm.missed])
+        for alarm in live_alarms:
+            self.scheduler.add(alarm)
+        if newly_missed:
+            self.save_changes('add', newly_missed)
+            self.prune_missed(site.siteid)
+
+    def start_timer(self, seconds, function):
+
+        """
+        Calls a function after some seconds (in the event loop or in the clock thread).
+        :param seconds: Delay in seconds
+        :param function: Function without parameters
+        :return: Timer object with a cancel() method
+        """
+
+        return self.timers.call_later(seconds, function)
+
+    def on_alarm_due(self, alarm):
+
+        """
+        Called by the scheduler (clock thread) when the time of an alarm has come. If the alarm is more
+        than a minute late (e.g. after the device was suspended) it is marked as missed instead.
+        :param alarm: The alarm object
+        :return: Nothing
+        """
+
+        with self.state_lock:
+            if alarm.passed or alarm.missed or alarm not in self.alarms:
+                # e.g. deleted by the MQTT thread after its timer was popped
+                return
+            alarm.passed = True
+            self.end_snooze([alarm])
+            self.update_next_alarm(alarm.site)
+            if ftime.get_now_time() - alarm.datetime >= datetime.timedelta(minutes=1):
+                self.set_missed(alarm)
+                self.save_changes('add', [alarm])
+                self.prune_missed(alarm.site.siteid)
+                return
+            self.metrics.scheduler_lag.observe((clock.now() - alarm.datetime).total_seconds() * 1000)
+            self.mqtt_client.publish('external/alarmclock/ringingStarted', json.dumps(alarm.get_data_dict()))
+            self.start_ringing(alarm, alarm.datetime)
+
+    def schedule_metrics(self):
+        if self.config['metrics_interval']:
+            self.metrics_due = clock.now() + datetime.timedelta(seconds=self.config['metrics_interval'])
+            self.timers.call_at(self.metrics_due, self.publish_metrics)
+
+    def prune_missed_periodically(self):
+
+        """
+        Drops the missed alarms which have reached missed_alarms_max_age, so they don't wait until the site
+        misses another alarm or the app is restarted. Called every PRUNE_INTERVAL seconds by the timer service.
+        :return: Nothing
+        """
+
+        self.timers.call_later(PRUNE_INTERVAL, self.prune_missed_periodically)
+        if self.config['missed_alarms_max_age']:
+            with self.state_lock:
+                self.prune_missed()
+
+    def publish_metrics(self):
+
+        """
+        Publishes a snapshot of the metrics on 'external/alarmclock/metrics' (and writes it to the metrics
+        file). Called periodically by the timer service, so missing snapshots mean a dead clock thread and
+        the timer lag shows how late the timers fire.
+        :return: Nothing
+        """
+
+        self.metrics.timer_lag.observe((clock.now() - self.metrics_due).total_seconds() * 1000)
+        self.schedule_metrics()
+        payload = json.dumps(self.get_metrics())
+        self.mqtt_client.publish('external/alarmclock/metrics', payload)
+        if self.config['metrics_file']:
+            try:
+                temp_path = self.config['metrics_file'] + ".tmp"
+                with io.open(temp_path, "w") as f:
+                    f.write(payload)
+                os.replace(temp_path, self.config['metrics_file'])
+            except (IOError, OSError) as e:
+                print("Error while writing metrics: ", e)
+
+    def get_metrics(self):
+        data = self.metrics.get_data_dict()
+        data['alarms'] = {siteid: len(self.alarms.range(siteid=siteid)) for siteid in self.sites_dict}
+        missed_counts = self.count_missed_alarms()
+        data['missed_alarms'] = {siteid: missed_counts.get(siteid, 0) for siteid in self.sites_dict}
+        data['ringing'] = [siteid for siteid, site in self.sites_dict.items() if site.state == STATE_RINGING]
+        data['pending_timers'] = self.timers.pending()
+        return data
+
+    def prepare_ringtone(self, site, reload=False):
 
-    def clock(self):
+        """
+        Renders the ringtone of a site as set in ringtone_rendering: now, in the background render pool or
+        (lazy) when the site rings for the first time.
+        :param site: The site object
+        :param reload: Whether the site already has an outdated ringtone (e.g. the volume was changed)
+        :return: Nothing
+        """
+
+        if self.config['ringtone_rendering'] == "lazy" and site.state != STATE_RINGING:
+            if reload:
+                site.ringtone_chunks = None
+                site.ringtone_wav = None
+        elif self.render_pool:
+            self.render_pool.submit(self.load_ringtone, site, reload)
+        elif self.config['ringtone_rendering'] == "startup" or reload:
+            self.load_ringtone(site, reload)
+
+    def load_ringtone(self, site, reload=False):
 
         """
-        Checks in a loop if the current time and date matches with one of the alarm dictionary.
+        Renders the ringtone of a site (or loads it from the ringtone store) if it isn't loaded yet.
+        Called at startup, by the background render pool or when the site rings for the first time.
+        :param site: The site object
+        :param reload: Render it again even if it is loaded (the old one is replaced when the new one is ready)
         :return: Nothing
         """
 
-        while True:
-            now_time = ftime.get_now_time()
-            if now_time in [alarm.datetime for alarm in self.get_alarms()]:
-                pending_alarms = [alarm for alarm in self.get_alarms(now_time) if not alarm.passed]
-                for alarm in pending_alarms:
-                    alarm.passed = True
-                    self.mqtt_client.publish('external/alarmclock/ringingStarted', json.dumps(alarm.get_data_dict()))
-                    self.start_ringing(alarm, now_time)
-            time.sleep(3)
+        if site.ringtone_wav is not None and not reload:
+            return
+        loops = self.config['ringtone_loops']
+        ringtone_chunks = None
+        if self.config['ringtone_chunk_size']:
+            ringtone_chunks = self.ringtone_store.get_chunks(
+                "alarm-sound.wav", site.ringing_volume, loops, site.ringtone_profile,
+                self.config['ringtone_chunk_size'] * 1024)
+        site.ringtone_wav = self.ringtone_store.get_payload("alarm-sound.wav", site.ringing_volume, loops,
+                                                            site.ringtone_profile)
+        site.chunk_index = 0
+        site.ringtone_chunks = ringtone_chunks
 
     def start_ringing(self, alarm, now_time):
         site = alarm.site
+        if site.state == STATE_RINGING:
+            # a second alarm of the site is due, the first one is done (and its ringing timeout cancelled)
+            self.stop_ringing(site)
         if site.ringtone_status:
+            self.load_ringtone(site)
             self.temp_memory[site.siteid] = {'alarm': now_time}
-            self.mqtt_client.message_callback_add('hermes/audioServer/{siteId}/playFinished'.format(
-                siteId=site.siteid), self.on_message_playfinished)
+            self.subscriptions.add(PLAY_FINISHED_TOPIC.format(site_id=site.siteid))
+            self.subscriptions.add(HOTWORD_DETECTED_TOPIC)
+            site.chunk_index = 0
+            site.played_count = 0
             self.ring(site)
+            if site.ringtone_chunks:
+                for _ in range(min(PREFETCH_CHUNKS, len(site.ringtone_chunks) - 1)):
+                    self.ring(site)
             site.ringing_alarm = alarm
-            site.timeout_thread = threading.Timer(site.ringing_timeout,
-                                                  functools.partial(self.timeout_reached, site))
-            site.timeout_thread.start()
+            site.state = STATE_RINGING
+            site.timer = self.start_timer(site.ringing_timeout, functools.partial(self.timeout_reached, site))
         else:
             self.mqtt_client.publish('external/alarmclock/ringingStopped', json.dumps(alarm.get_data_dict()))
+            self.finish_alarm(alarm)
 
     def ring(self, site):
 
         """
-        Publishes the ringtone wav over MQTT to the soundserver and generates a random UUID for it.
+        Publishes the ringtone wav (or the next chunk of it) over MQTT to the soundserver and generates a
+        random UUID for it.
         :param site: The site object (site of the user)
         :return: Nothing
         """
 
-        site.ringtone_id = str(uuid.uuid4())
+        if site.ringtone_chunks:
+            payload = site.ringtone_chunks[site.chunk_index]
+            site.chunk_index = (site.chunk_index + 1) % len(site.ringtone_chunks)
+        else:
+            # shared by all sites with the same ringtone (see RingtoneStore.get_payload)
+            payload = site.ringtone_wav
+        ringtone_id = str(uuid.uuid4())
+        site.ringtone_ids.add(ringtone_id)
         self.mqtt_client.publish('hermes/audioServer/{site_id}/playBytes/{ring_id}'.format(
-            site_id=site.siteid, ring_id=site.ringtone_id), payload=site.ringtone_wav)
+            site_id=site.siteid, ring_id=ringtone_id), payload=payload)
 
     def stop_ringing(self, site):
 
         """
-        Sets self.ringing_dict[siteId] to False so on_message_playfinished won't start a new ring.
+        Sets self.ringing_dict[siteId] to False so on_message_playfinished won't start a new ring. The alarm
+        is deleted (see finish_alarm).
         :param site: The site object (site of the user)
         :return: Nothing
         """
 
         self.mqtt_client.publish('external/alarmclock/ringingStopped',
                                  json.dumps(site.ringing_alarm.get_data_dict()))
-        # TODO: delete alarm after captcha or snooze or sth
+        self.finish_alarm(site.ringing_alarm)
+        loops = site.played_count * self.config['ringtone_loops']
+        if site.ringtone_chunks:
+            loops /= len(site.ringtone_chunks)
+        self.metrics.ringing_loops.observe(loops)
         site.ringing_alarm = None
-        site.ringtone_id = None
-        site.timeout_thread.cancel()  # cancel timeout thread from siteId
-        site.timeout_thread = None
-        self.mqtt_client.message_callback_remove('hermes/audioServer/{site_id}/playFinished'.format(
-            site_id=site.siteid))
+        site.ringtone_ids = set()
+        site.state = STATE_IDLE
+        site.timer.cancel()  # cancel the ringing timeout of the site
+        site.timer = None
+        self.subscriptions.remove(PLAY_FINISHED_TOPIC.format(site_id=site.siteid))
+        self.subscriptions.remove(HOTWORD_DETECTED_TOPIC)
+
+    def finish_alarm(self, alarm):
+
+        """
+        Deletes an alarm which has rung, so the live alarms only contain pending and ringing alarms and
+        the next alarm of a site is found at the head of its index. Alarms which weren't stopped in time are
+        kept as missed alarms instead (see timeout_reached).
+        :param alarm: The alarm object
+        :return: Nothing
+        """
+
+        if self.alarms.remove(alarm):
+            self.update_next_alarm(alarm.site)
+            self.save_changes('delete', [alarm])
 
     def timeout_reached(self, site):
-        site.ringing_alarm.missed = True
-        self.stop_ringing(site)
+        with self.state_lock:
+            if site.state != STATE_RINGING:
+                return
+            alarm = site.ringing_alarm
+            moved = self.set_missed(alarm)
+            self.stop_ringing(site)
+            if moved:
+                # not if the alarm was changed or deleted (bulk API) while it was ringing
+                self.save_changes('add', [alarm])
+                self.prune_missed(site.siteid)
+
+    def session_expired(self, site):
+        with self.state_lock:
+            # the hotword was detected, but no session was started
+            if site.state != STATE_AWAITING_SESSION:
+                return
+            site.state = STATE_IDLE
+            site.timer = None
+            self.temp_memory[site.siteid] = None
+            self.subscriptions.remove(SESSION_STARTED_TOPIC)
 
     def on_message_playfinished(self, client, userdata, msg):
 
         """
-        Called when ringtone was played on specific site. If self.ringing_dict[siteId] is True, the
-        ringtone is played again.
+        Called when ringtone (or a chunk of it) was played on specific site. If the site is still ringing,
+        the next part of the ringtone is played.
         :param client: MQTT client object (from paho)
         :param userdata: MQTT userdata (from paho)
         :param msg: MQTT message object (from paho)
         :return: Nothing
         """
 
-        site = self.sites_dict[json.loads(msg.payload.decode("utf-8"))['siteId']]
-        if site.ringing_alarm and site.ringtone_id == json.loads(msg.payload.decode("utf-8"))['id']:
-            self.ring(site)
+        # topic: hermes/audioServer/<siteId>/playFinished
+        site = self.sites_dict.get(msg.topic.split("/")[2])
+        if not site or site.state != STATE_RINGING:
+            return
+        data = json.loads(msg.payload.decode("utf-8"))
+        with self.state_lock:
+            if site.state == STATE_RINGING and data['id'] in site.ringtone_ids:
+                site.ringtone_ids.discard(data['id'])
+                site.played_count += 1
+                self.ring(site)
 
     def on_message_hotword(self, client, userdata, msg):
 
@@ -171,11 +563,12 @@ class AlarmControl:
         """
         data = json.loads(msg.payload.decode())
         site = self.sites_dict.get(data['siteId'])
-        if site and site.ringing_alarm:
-            self.stop_ringing(site)
-            site.session_pending = True  # TODO
-            self.mqtt_client.message_callback_add('hermes/dialogueManager/sessionStarted',
-                                                  self.on_message_sessionstarted)
+        with self.state_lock:
+            if site and site.state == STATE_RINGING:
+                self.stop_ringing(site)
+                site.state = STATE_AWAITING_SESSION
+                site.timer = self.start_timer(SESSION_TIMEOUT, functools.partial(self.session_expired, site))
+                self.subscriptions.add(SESSION_STARTED_TOPIC)
 
     def on_message_stopringing(self, client, userdata, msg):
 
@@ -189,8 +582,9 @@ class AlarmControl:
 
         data = json.loads(msg.payload.decode())
         site = self.sites_dict.get(data['siteId'])
-        if site and site.ringing_alarm:
-            self.stop_ringing(site)
+        with self.state_lock:
+            if site and site.state == STATE_RINGING:
+                self.stop_ringing(site)
 
     def on_message_sessionstarted(self, client, userdata, msg):
 
@@ -204,22 +598,23 @@ class AlarmControl:
         """
         data = json.loads(msg.payload.decode())
         site = self.sites_dict.get(data['siteId'])
-        if not site:
-            return
+        with self.state_lock:
+            if not site or site.state != STATE_AWAITING_SESSION:
+                return
+            site.state = STATE_IDLE
+            site.timer.cancel()
+            site.timer = None
+            self.subscriptions.remove(SESSION_STARTED_TOPIC)
 
         # self.mqtt_client.publish('hermes/asr/toggleOn')
-        if not self.config['snooze_config']['state'] and site.session_pending:
-            site.session_pending = False
-            self.mqtt_client.message_callback_remove('hermes/dialogueManager/sessionStarted')
-            now_time = datetime.datetime.now()
+        if not self.config['snooze_config']['state']:
+            now_time = clock.now()
             text = self.translation.get("Alarm is now ended.") + " " + self.translation.get("It's {h}:{min} .", {
                 'h': ftime.get_alarm_hour(now_time), 'min': ftime.get_alarm_minute(now_time)})
             self.mqtt_client.publish('hermes/dialogueManager/endSession',
                                      json.dumps({"text": text, "sessionId": data['sessionId']}))
 
-        elif self.config['snooze_config']['state'] and site.session_pending:
-            site.session_pending = False
-            self.mqtt_client.message_callback_remove('hermes/dialogueManager/sessionStarted')
+        else:
             self.mqtt_client.publish('hermes/dialogueManager/endSession',
                                      json.dumps({"sessionId": data['sessionId']}))
             # self.mqtt_client.subscribe('hermes/nlu/intentNotRecognized')
@@ -230,64 +625,448 @@ class AlarmControl:
                                                           'canBeEnqueued': True,
                                                           'intentFilter': ["domi:answerAlarm"]}}))
 
+    def on_message_bulk(self, client, userdata, msg):
+
+        """
+        Called when message 'external/alarmclock/bulk' was received via MQTT. Applies the request (see
+        apply_bulk) and answers on 'external/alarmclock/bulk/response'.
+        :param client: MQTT client object (from paho)
+        :param userdata: MQTT userdata (from paho)
+        :param msg: MQTT message object (from paho)
+        :return: Nothing
+        """
+
+        try:
+            request = json.loads(msg.payload.decode("utf-8"))
+        except ValueError:
+            request = None
+        if isinstance(request, dict):
+            response = self.apply_bulk(request)
+        else:
+            response = {'requestId': None, 'ok': False, 'errors': [{'error': "payload is not a JSON object"}]}
+        self.mqtt_client.publish(BULK_TOPIC + '/response', json.dumps(response))
+
+    def _parse_bulk_item(self, item, alarm=None):
+        if not isinstance(item, dict):
+            raise ValueError("item is not a JSON object")
+        siteid = item.get('siteId', alarm.site.siteid if alarm else None)
+        if siteid not in self.sites_dict:
+            raise ValueError("unknown siteId {}".format(siteid))
+        if 'datetime' in item or not alarm:
+            try:
+                datetime_obj = datetime.datetime.strptime(item['datetime'], "%Y-%m-%d %H:%M")
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("datetime must have the format YYYY-MM-DD HH:MM")
+        else:
+            datetime_obj = alarm.datetime
+        if datetime_obj <= clock.now():
+            raise ValueError("datetime is in the past")
+        return datetime_obj, self.sites_dict[siteid], item.get('repetition', alarm.repetition if alarm else None)
+
+    def apply_bulk(self, request):
+
+        """
+        Creates, changes and deletes many alarms at once. The request is validated completely first and
+        applied only if every item is valid. All changes are persisted with one write and announced with one
+        message of the change feed.
+        :param request: Dictionary with the optional keys 'requestId', 'add' (list with dictionaries with
+                        'datetime' ("YYYY-MM-DD HH:MM"), 'siteId' and optionally 'repetition'), 'update' (same,
+                        with 'id' and only the changed keys) and 'delete' (list with alarm ids)
+        :return: Response dictionary with 'requestId', 'ok' and 'errors' or the changed alarms and the
+                 sequence number of the change feed
+        """
+
+        with self.state_lock:
+            # nothing rings, times out or goes missed while the request is validated and applied
+            return self._apply_bulk(request)
+
+    def _apply_bulk(self, request):
+        errors = []
+        added = []
+        updates = []
+        deleted = []
+        # missed alarms in the store and alarms of removed sites, only looked up if needed
+        deleted_dicts = []
+        other_alarms = None
+        alarms_by_id = {alarm.id: alarm for alarms in [self.alarms, self.missed_alarms] for alarm in alarms}
+        seen_ids = set()
+        for index, item in enumerate(request.get('add') or []):
+            try:
+                datetime_obj, site, repetition = self._parse_bulk_item(item)
+                added.append(Alarm(datetime_obj, site, repetition))
+            except ValueError as e:
+                errors.append({'op': 'add', 'index': index, 'error': str(e)})
+        for index, item in enumerate(request.get('update') or []):
+            try:
+                alarm = alarms_by_id.get(item.get('id') if isinstance(item, dict) else None)
+                if not alarm or alarm.missed:
+                    raise ValueError("unknown alarm id")
+                if alarm.id in seen_ids:
+                    raise ValueError("alarm id appears more than once")
+                seen_ids.add(alarm.id)
+                updates.append((alarm, self._parse_bulk_item(item, alarm)))
+            except ValueError as e:
+                errors.append({'op': 'update', 'index': index, 'error': str(e)})
+        for index, alarm_id in enumerate(request.get('delete') or []):
+            if alarm_id not in alarms_by_id and other_alarms is None:
+                other_alarms = self._get_other_alarms()
+            if alarm_id in seen_ids or (alarm_id not in alarms_by_id and alarm_id not in other_alarms):
+                errors.append({'op': 'delete', 'index': index, 'error': "unknown alarm id or already changed"})
+                continue
+            seen_ids.add(alarm_id)
+            if alarm_id in alarms_by_id:
+                deleted.append(alarms_by_id[alarm_id])
+            else:
+                deleted_dicts.append(other_alarms[alarm_id])
+        if errors:
+            return {'requestId': request.get('requestId'), 'ok': False, 'errors': errors}
+        if not (added or updates or deleted or deleted_dicts):
+            return {'requestId': request.get('requestId'), 'ok': True, 'added': [], 'updated': [], 'deleted': []}
+
+        # an updated alarm is replaced by a new object with the same id, so indexed alarms never change and
+        # an alarm which has already rung (passed) rings again at its new datetime
+        replaced = [alarm for alarm, _ in updates]
+        updated = [Alarm(datetime_obj, site, repetition, alarm_id=alarm.id)
+                   for alarm, (datetime_obj, site, repetition) in updates]
+        changed_sites = {alarm.site for alarm in added + replaced + updated + deleted}
+        for alarm in replaced + deleted:
+            self.scheduler.remove(alarm)
+        # one new snapshot of the index
+        self.alarms.update(added=added + updated, removed=replaced + deleted)
+        self.missed_alarms.update(removed=deleted)
+        self.end_snooze(replaced + deleted)
+        for alarm_dict in deleted_dicts:
+            if alarm_dict in self.orphaned_alarms.get(alarm_dict['siteid'], []):
+                self.orphaned_alarms[alarm_dict['siteid']].remove(alarm_dict)
+        for alarm in added + updated:
+            self.scheduler.add(alarm)
+        for site in changed_sites:
+            self.update_next_alarm(site)
+        seq = self.save_records(
+            AlarmJournal.make_records('add', [alarm.get_data_dict() for alarm in added + updated]) +
+            AlarmJournal.make_records('delete', [alarm.get_data_dict() for alarm in deleted] + deleted_dicts))
+        return {'requestId': request.get('requestId'), 'ok': True, 'seq': seq,
+                'added': [alarm.get_data_dict() for alarm in added],
+                'updated': [alarm.get_data_dict() for alarm in updated],
+                'deleted': [alarm.id for alarm in deleted] + [alarm_dict['id'] for alarm_dict in deleted_dicts]}
+
+    def _get_other_alarms(self):
+
+        """
+        Returns the alarms which aren't held as objects: the missed alarms in the store (store mode) and the
+        alarms of removed sites.
+        :return: Dictionary with the alarm id as key and the alarm dictionary as value
+        """
+
+        if self.store:
+            return {alarm_dict['id']: alarm_dict for alarm_dict in self.store.query(pending=self.writer.get_pending())}
+        return {alarm_dict['id']: alarm_dict
+                for alarm_dicts in self.orphaned_alarms.values() for alarm_dict in alarm_dicts}
+
+    def snooze(self, alarmobj):
+
+        """
+        Adds the alarm which rings again after snoozing and sets the state of its site.
+        :param alarmobj: The new alarm object
+        :return: Nothing
+        """
+
+        with self.state_lock:
+            alarmobj.site.state = STATE_SNOOZED
+            alarmobj.site.snooze_alarm = alarmobj
+        self.add(alarmobj)
+
+    def end_snooze(self, alarms):
+
+        """
+        Sets a snoozed site back to idle if its snooze alarm is due (it starts ringing), changed or deleted.
+        :param alarms: List with the alarm objects which aren't pending anymore
+        :return: Nothing
+        """
+
+        with self.state_lock:
+            for alarm in alarms:
+                if alarm.site.snooze_alarm is alarm:
+                    alarm.site.snooze_alarm = None
+                    if alarm.site.state == STATE_SNOOZED:
+                        alarm.site.state = STATE_IDLE
+
     def add(self, alarmobj):
         if alarmobj not in self.alarms:
-            self.alarms.append(alarmobj)
-        self.save()
+            self.alarms.add(alarmobj)
+            self.scheduler.add(alarmobj)
+            self.update_next_alarm(alarmobj.site)
+        self.save_changes('add', [alarmobj])
+
+    def update_next_alarm(self, site):
+
+        """
+        Publishes the next pending alarm of a site as retained message on 'external/alarmclock/<siteId>/next'
+        (JSON null if there is none) if it has changed. Called after every change of the live alarms of the
+        site, it only looks at the head of the index of the site (at most the ringing alarm is skipped).
+        :param site: The site object
+        :return: Nothing
+        """
+
+        with self.next_lock:
+            if site.siteid not in self.sites_dict:
+                # removed site -> clear the retained message
+                if self.next_alarms.pop(site.siteid, None) is not None:
+                    self.mqtt_client.publish(NEXT_ALARM_TOPIC.format(site_id=site.siteid), None, retain=True)
+                return
+            alarm = self.alarms.first(site.siteid, skip=lambda alarm: alarm.passed)
+            payload = json.dumps(alarm.get_data_dict() if alarm else None)
+            if self.next_alarms.get(site.siteid) != payload:
+                self.next_alarms[site.siteid] = payload
+                self.mqtt_client.publish(NEXT_ALARM_TOPIC.format(site_id=site.siteid), payload, retain=True)
+
+    def save_changes(self, op, alarms):
+
+        """
+        Persists a change of the alarms in the background. In journal mode only the changed alarms are
+        appended to the journal (and a snapshot is written when it has grown too big), in sqlite mode they
+        are written in one transaction, otherwise all alarms are saved.
+        :param op: 'add' (also used for changed alarms) or 'delete'
+        :param alarms: List with the changed alarm objects
+        :return: Nothing
+        """
+
+        if alarms:
+            self.save_records(AlarmJournal.make_records(op, [alarm.get_data_dict() for alarm in alarms]))
+        elif not (self.store or self.journal):
+            self.save()
+
+    def save_records(self, records):
+
+        """
+        Persists several changes (see AlarmJournal.make_records) with one write: one transaction in sqlite
+        mode, one append to the journal or one snapshot. The changes are published with one message of the
+        change feed.
+        :param records: List with records
+        :return: Sequence number of the change feed message
+        """
+
+        if self.store or self.journal:
+            self.writer.extend(records)
+        else:
+            self.save()
+        return self.changes.publish(records)
 
     def save(self):
-        with io.open(self.saved_alarms_path, "w") as f:
-            f.write(json.dumps(self.get_unpacked_objects_list()))
+        self.writer.request_snapshot()
+
+    def flush(self, timeout=None):
+
+        """
+        Blocks until all changes of the alarms are written to disk (e.g. before shutdown).
+        :param timeout: Maximum seconds to wait (None: wait forever)
+        :return: True if everything was written
+        """
+
+        return self.writer.flush(timeout)
+
+    def write_snapshot(self):
+
+        """
+        Writes a snapshot of all alarms (atomically with a temporary file) and clears the journal.
+        In journal mode only the journaled alarms are compacted, the live alarms can already contain
+        changes which are still waiting for the writer. Called by the writer thread.
+        :return: Number of written bytes
+        """
+
+        if self.store:
+            return self.store.write_snapshot(self.get_unpacked_objects_list())
+        if self.journal:
+            data = json.dumps(self.journal.get_alarms())
+        else:
+            data = json.dumps(self.get_unpacked_objects_list())
+        temp_path = self.saved_alarms_path + ".tmp"
+        with io.open(temp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.saved_alarms_path)
+        if self.journal:
+            self.journal.clear()
+        return len(data)
 
     def restore(self):
+        if self.store:
+            if not self.store.count() and os.path.exists(self.saved_alarms_path):
+                # first start with sqlite: import the alarms of the JSON file
+                self.store.write_snapshot(self.read_saved_alarms())
+            return self.get_alarm_objects(self.store.query(missed=False))
+        alarms_list = self.read_saved_alarms()
+        if self.journal:
+            alarms_list = self.journal.replay(alarms_list)
+        for alarm_dict in alarms_list:
+            if alarm_dict['siteid'] not in self.sites_dict:
+                self.orphaned_alarms.setdefault(alarm_dict['siteid'], []).append(alarm_dict)
+        return self.get_alarm_objects(alarms_list)
+
+    def read_saved_alarms(self):
         with io.open(self.saved_alarms_path, "r") as f:
             try:
-                alarms = []
                 alarms_list = json.load(f)
-                for alarm_dict in alarms_list:
-                    alarm = Alarm(site=self.sites_dict[alarm_dict['siteid']],
-                                  repetition=alarm_dict['repetition'],
-                                  missed=alarm_dict['missed'])
-                    alarm.set_datetime_str(alarm_dict['datetime'])
-                    alarms.append(alarm)
-                return alarms
             except (ValueError, TypeError):
-                return []
+                alarms_list = []
+        for alarm_dict in alarms_list:
+            # alarms saved by older versions have no id
+            alarm_dict.setdefault('id', str(uuid.uuid4()))
+        return alarms_list
+
+    def get_alarm_objects(self, alarms_list):
+        try:
+            alarms = []
+            for alarm_dict in alarms_list:
+                if alarm_dict['siteid'] not in self.sites_dict:
+                    # the site was removed from the config
+                    continue
+                alarm = Alarm(site=self.sites_dict[alarm_dict['siteid']],
+                              repetition=alarm_dict['repetition'],
+                              missed=alarm_dict['missed'],
+                              alarm_id=alarm_dict['id'])
+                alarm.set_datetime_str(alarm_dict['datetime'])
+                alarms.append(alarm)
+            return alarms
+        except (ValueError, TypeError):
+            return []
 
     def check_set_missed(self):
-        for alarm in self.alarms:
-            alarm.missed = alarm.check_missed()
+        missed_alarms = [alarm for alarm in self.alarms if alarm.check_missed()]
+        for alarm in missed_alarms:
+            self.set_missed(alarm)
+        return missed_alarms
+
+    def set_missed(self, alarm):
+
+        """
+        Marks an alarm as missed and moves it from the live alarms to the missed alarms.
+        :param alarm: The alarm object
+        :return: False if the alarm isn't a live alarm anymore (e.g. it was deleted in the meantime)
+        """
+
+        alarm.missed = True
+        if not self.alarms.remove(alarm):
+            return False
+        if not self.store:
+            self.missed_alarms.add(alarm)
+        self.update_next_alarm(alarm.site)
+        return True
+
+    def prune_missed(self, siteid=None):
+
+        """
+        Drops the oldest missed alarms which exceed missed_alarms_max or missed_alarms_max_age.
+        :param siteid: Only prune the missed alarms of this site (default: all sites)
+        :return: Nothing
+        """
+
+        if self.store:
+            if self.config['missed_alarms_max_age']:
+                before = clock.now() - datetime.timedelta(days=self.config['missed_alarms_max_age'])
+            else:
+                before = None
+            # only read here, the alarms are deleted by the writer
+            alarm_ids = self.store.get_missed_to_prune(self.config['missed_alarms_max'], before,
+                                                       pending=self.writer.get_pending())
+            if alarm_ids:
+                self.save_records(AlarmJournal.make_records('delete', [{'id': alarm_id} for alarm_id in alarm_ids]))
+            return
+        dropped = self.missed_alarms.prune(siteid)
+        if dropped:
+            self.save_changes('delete', dropped)
+
+    def get_snapshot(self):
+
+        """
+        Returns all alarms (also the missed alarms and those of removed sites) for a snapshot of the change feed.
+        :return: List with alarm dictionaries
+        """
+
+        if self.store:
+            return self.store.query(pending=self.writer.get_pending())
+        return self.get_unpacked_objects_list()
 
     def get_unpacked_objects_list(self):
         alarms_list = []
-        for alarm in self.alarms:
-            alarms_list.append(alarm.get_data_dict())
+        for alarms in [self.alarms, self.missed_alarms]:
+            for alarm in alarms:
+                alarms_list.append(alarm.get_data_dict())
+        for alarm_dicts in self.orphaned_alarms.values():
+            alarms_list.extend(alarm_dicts)
         return alarms_list
 
-    def get_alarms(self, dtobject=None, siteid=None, only_ringing=False):
-        if only_ringing:
-            filtered_alarms = [alarm for alarm in self.alarms if alarm.ringing and not alarm.missed]
-        else:
-            filtered_alarms = [alarm for alarm in self.alarms if not alarm.missed]
+    def get_alarms(self, dtobject=None, siteid=None, only_ringing=False, start=None, end=None):
+
+        """
+        Returns the live alarms sorted by datetime.
+        :param dtobject: Only alarms at exactly this datetime
+        :param siteid: Only alarms of this site
+        :param only_ringing: Only alarms which are ringing at the moment
+        :param start: Only alarms at or after this datetime
+        :param end: Only alarms at or before this datetime
+        :return: List with alarm objects
+        """
+
         if dtobject:
-            filtered_alarms = [alarm for alarm in filtered_alarms if alarm.datetime == dtobject]
-        if siteid:
-            filtered_alarms = [alarm for alarm in filtered_alarms if alarm.site.siteid == siteid]
+            start = end = dtobject
+        filtered_alarms = self.alarms.range(start, end, siteid)
+        if only_ringing:
+            filtered_alarms = [alarm for alarm in filtered_alarms if alarm.ringing]
         return filtered_alarms
 
-    def get_missed_alarms(self, dtobject=None, siteid=None):
-        filtered_alarms = [alarm for alarm in self.alarms if alarm.missed]
+    def get_missed_alarms(self, dtobject=None, siteid=None, start=None, end=None):
+
+        """
+        Returns the missed alarms of the archive (or the store) sorted by datetime.
+        :param dtobject: Only alarms at exactly this datetime
+        :param siteid: Only alarms of this site
+        :param start: Only alarms at or after this datetime
+        :param end: Only alarms at or before this datetime
+        :return: List with alarm objects
+        """
+
         if dtobject:
-            filtered_alarms = [alarm for alarm in filtered_alarms if alarm.datetime == dtobject]
-        if siteid:
-            filtered_alarms = [alarm for alarm in filtered_alarms if alarm.site.siteid == siteid]
-        return filtered_alarms
+            start = end = dtobject
+        if self.store:
+            # including the changes which are still waiting for the writer
+            return self.get_alarm_objects(self.store.query(start, end, siteid, missed=True,
+                                                           pending=self.writer.get_pending()))
+        return self.missed_alarms.range(start, end, siteid)
+
+    def count_missed_alarms(self):
+
+        """
+        Counts the missed alarms per site without loading them.
+        :return: Dictionary with siteId as key and the number of missed alarms as value
+        """
+
+        if self.store:
+            return self.store.count(missed=True, pending=self.writer.get_pending())
+        return self.missed_alarms.count()
+
+    def _remove(self, alarm):
+        self.scheduler.remove(alarm)
+        if not self.alarms.remove(alarm):
+            self.missed_alarms.remove(alarm)
+        self.end_snooze([alarm])
+
+    def _remove_many(self, alarms):
+        for alarm in alarms:
+            self.scheduler.remove(alarm)
+        # readers see all or none of the alarms removed
+        self.alarms.update(removed=alarms)
+        self.missed_alarms.update(removed=alarms)
+        self.end_snooze(alarms)
 
     def delete_single(self, alarm):
-        self.alarms.remove(alarm)
-        self.save()
+        self._remove(alarm)
+        self.update_next_alarm(alarm.site)
+        self.save_changes('delete', [alarm])
 
     def delete_multi(self, alarms):
-        for alarm in alarms:
-            self.alarms.remove(alarm)
-        self.save()
+        self._remove_many(alarms)
+        for site in {alarm.site for alarm in alarms}:
+            self.update_next_alarm(site)
+        self.save_changes('delete', alarms)
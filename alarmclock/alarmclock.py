@@ -2,15 +2,25 @@
 #                                    Explanations:
 import datetime                      # date and time
 import json                          # payload in mqtt messages
+import time                          # startup time
+from . import clock                         # clock.py
 from . import utils                         # utils.py
 from . import formattime as ftime           # ftime.py
 from . alarm import Alarm, AlarmControl
+from . configwatcher import ConfigWatcher
+from . metrics import Metrics, MeteredMqttClient
 from . translation import Translation  # translation.py
 
 
 class AlarmClock:
-    def __init__(self, mqtt_client):
-        self.config = utils.get_config("config.ini", "config.ini.default")
+    def __init__(self, mqtt_client, start_time=None, config=None, loop=None, clock_obj=None, metrics=None):
+        if clock_obj:
+            # e.g. a SimulatedClock which replays the alarms faster than real time
+            clock.set_clock(clock_obj)
+        self.start_time = start_time or time.time()
+        if not config:
+            config = utils.get_config("config.ini", "config.ini.default")
+        self.config = config
         # self.dict_siteids -> { key=RoomName: value=siteId }
         self.dict_siteids = self.config['dict_siteids']
         self.default_room = self.config['default_room']
@@ -19,13 +29,47 @@ class AlarmClock:
         # Language
         self.language = "de-DE"
         self.translation = Translation(self.language)
-        # Connect to MQTT broker
-        self.mqtt_client = mqtt_client
-        # TODO: Publish other messages over mqtt
-        self.mqtt_client.subscribe([('external/alarmclock/#', 0), ('hermes/dialogueManager/#', 0),
-                                    ('hermes/hotword/#', 0), ('hermes/audioServer/#', 0)])
+        # Connect to MQTT broker (published messages and bytes are counted in the metrics)
+        self.metrics = metrics or Metrics()
+        self.mqtt_client = MeteredMqttClient(mqtt_client, self.metrics)
         # Create alarmcontrol instance
-        self.alarmctl = AlarmControl(self.config, self.language, self.mqtt_client, self.temp_memory)
+        self.alarmctl = AlarmControl(self.config, self.language, self.mqtt_client, self.temp_memory, loop=loop,
+                                     metrics=self.metrics)
+        self.config_watcher = None
+        if self.config['config_reload_interval']:
+            # rooms, volumes, timeouts etc. are applied without a restart
+            self.config_watcher = ConfigWatcher("config.ini", self.alarmctl.timers,
+                                                self.config['config_reload_interval'], self.reload_config)
+            self.config_watcher.start()
+
+    def publish_ready(self):
+
+        """
+        Publishes 'external/alarmclock/ready' with the startup time. Called after the intents were subscribed.
+        :return: Nothing
+        """
+
+        self.mqtt_client.publish('external/alarmclock/ready',
+                                 json.dumps({'startupTime': round(time.time() - self.start_time, 3),
+                                             'sites': len(self.alarmctl.sites_dict)}))
+
+    def reload_config(self, config=None):
+
+        """
+        Reads the config again and applies the changes (called by the config watcher).
+        :param config: New config dictionary (default: read from config.ini)
+        :return: Dictionary with the changed siteIds (see AlarmControl.apply_config)
+        """
+
+        if not config:
+            config = utils.get_config("config.ini", "config.ini.default", strict=True)
+        changes = self.alarmctl.apply_config(config)
+        self.dict_siteids = self.config['dict_siteids']
+        self.default_room = self.config['default_room']
+        if self.config_watcher and self.config_watcher.interval != self.config['config_reload_interval']:
+            self.config_watcher.set_interval(self.config['config_reload_interval'])
+        self.mqtt_client.publish('external/alarmclock/configReloaded', json.dumps(changes))
+        return changes
 
     def new_alarm(self, slots, siteid):
 
@@ -98,10 +142,8 @@ class AlarmClock:
         else:
             alarm = Alarm(alarm_time, self.alarmctl.sites_dict[alarm_site_id], repetition=None)
             self.alarmctl.add(alarm)
-            # alarm dictionary with datetime objects as strings { key=datetime_str: value=siteId_list }
-            self.mqtt_client.publish('external/alarmclock/newalarm',
-                                     json.dumps({'new': alarm.get_data_dict(),
-                                                 'all': self.alarmctl.get_unpacked_objects_list()}))
+            # only the new alarm, the other alarms can be followed with the change feed
+            self.mqtt_client.publish('external/alarmclock/newalarm', json.dumps({'new': alarm.get_data_dict()}))
             response = self.translation.get("The alarm will ring {room_part} {future_part} at {h}:{min} .", {
                 'future_part': self.get_time_description(alarm_time),
                 'h': ftime.get_alarm_hour(alarm_time),
@@ -110,7 +152,7 @@ class AlarmClock:
             return self.del_multi_spaces(response)
 
     def get_alarms(self, slots, siteid):
-        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms(), slots, siteid)
+        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms, slots, siteid)
 
         if rc > 0:
             return self.error_sentence(rc, words_dict)
@@ -144,7 +186,7 @@ class AlarmClock:
         return self.del_multi_spaces(response)
 
     def get_next_alarm(self, slots, siteid):
-        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms(), slots, siteid)
+        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms, slots, siteid)
 
         if rc > 0:
             return self.error_sentence(rc, words_dict)
@@ -172,11 +214,11 @@ class AlarmClock:
         return self.del_multi_spaces(response)
 
     def get_missed_alarms(self, slots, siteid):
-        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_missed_alarms(),
+        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_missed_alarms,
                                                              slots, siteid, timeslot_with_past=True)
         if rc > 0:
             return self.error_sentence(rc, words_dict)
-        filtered_alarms.sort(reverse=True)  # sort from old to new (say oldest alarms first)
+        # filtered alarms are sorted from old to new (say oldest alarms first)
 
         alarm_count = len(filtered_alarms)
         if alarm_count <= 1:
@@ -245,7 +287,7 @@ class AlarmClock:
                     'alarm_count' - Number of matching alarms (if alarms are ringing in two rooms at
                                     one time, this means two alarms)
         """
-        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms(), slots, siteid)
+        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms, slots, siteid)
 
         if rc > 0:
             return None, self.error_sentence(rc, words_dict)
@@ -284,7 +326,7 @@ class AlarmClock:
         Removes all alarms in the list "alarms_delete".
         :return: String "Done."
         """
-        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms(), slots, siteid)
+        rc, filtered_alarms, words_dict = self.filter_alarms(self.alarmctl.get_alarms, slots, siteid)
         self.alarmctl.delete_multi(filtered_alarms)
         return self.translation.get("Done.")
 
@@ -311,7 +353,7 @@ class AlarmClock:
             answer_slot = None
 
         if not answer_slot or answer_slot == "snooze":
-            self.alarmctl.add(next_alarm)
+            self.alarmctl.snooze(next_alarm)
             return "Ich wecke dich wieder in {min} Minuten.".format(min=duration)
 
         elif slots['answer'] == "stop" and not self.config("challenge"):
@@ -319,15 +361,20 @@ class AlarmClock:
         else:
             return "Ich wecke dich in 5 Minuten."
 
-    def filter_alarms(self, alarms, slots, siteid, timeslot_with_past=False):
+    def filter_alarms(self, query, slots, siteid, timeslot_with_past=False):
 
-        """Helper function which filters alarms with datetime and rooms"""
+        """
+        Helper function which filters alarms with datetime and rooms.
+        :param query: Lookup function of AlarmControl (get_alarms or get_missed_alarms) which is called
+                      with the time range and siteId and returns the matching alarms sorted by datetime
+        """
 
         future_part = ""
         time_part = ""
         room_part = ""
-        # fill the list with all alarms and then filter it
-        filtered_alarms = [alarm for alarm in alarms]
+        start = None
+        end = None
+        context_siteid = None
         dt_format = "%Y-%m-%d %H:%M"
         if 'time' in slots.keys():
             if slots['time']['kind'] == "InstantTime":
@@ -336,16 +383,16 @@ class AlarmClock:
                 if slots['time']['grain'] == "Hour" or slots['time']['grain'] == "Minute":
                     if not timeslot_with_past and ftime.get_delta_obj(alarm_time, only_date=False).days < 0:
                         return 1, None, None
-                    filtered_alarms = [alarm for alarm in filtered_alarms
-                                       if alarm.datetime == alarm_time]
+                    start = end = alarm_time
                     time_part = self.translation.get("at {h}:{min}",
                                                      {'h': ftime.get_alarm_hour(alarm_time),
                                                       'min': ftime.get_alarm_minute(alarm_time)})
                 else:
                     alarm_date = alarm_time.date()
-                    if (alarm_date - datetime.datetime.now().date()).days < 0:
+                    if (alarm_date - clock.now().date()).days < 0:
                         return 1, None, None
-                    filtered_alarms = [alarm for alarm in filtered_alarms if alarm.datetime.date() == alarm_date]
+                    start = datetime.datetime.combine(alarm_date, datetime.time.min)
+                    end = datetime.datetime.combine(alarm_date, datetime.time.max)
             elif slots['time']['kind'] == "TimeInterval":
                 time_from = None
                 time_to = None
@@ -353,12 +400,8 @@ class AlarmClock:
                     time_from = datetime.datetime.strptime(ftime.alarm_time_str(slots['time']['from']), dt_format)
                 if slots['time']['to']:
                     time_to = datetime.datetime.strptime(ftime.alarm_time_str(slots['time']['to']), dt_format)
-                if not time_from and time_to:
-                    filtered_alarms = [alarm for alarm in filtered_alarms if alarm.datetime <= time_to]
-                elif not time_to and time_from:
-                    filtered_alarms = [alarm for alarm in filtered_alarms if time_from <= alarm.datetime]
-                else:
-                    filtered_alarms = [alarm for alarm in filtered_alarms if time_from <= alarm.datetime <= time_to]
+                start = time_from
+                end = time_to
                 future_part = self.get_interval_part(time_from, time_to)
             else:
                 return 2, None, None
@@ -374,16 +417,9 @@ class AlarmClock:
                     context_siteid = self.dict_siteids[room_slot]
                 else:
                     return 4, None, {'room': room_slot}
-            filtered_alarms = [alarm for alarm in filtered_alarms if alarm.get_siteid() == context_siteid]
             room_part = self.get_roomstr([context_siteid], siteid)
-        filtered_dtobjects_sorted = [alarm.datetime for alarm in filtered_alarms]
-        filtered_dtobjects_sorted.sort()
-        filtered_alarms_sorted = []
-        for dtobject in filtered_dtobjects_sorted:
-            alarms = [alarm for alarm in filtered_alarms if alarm.datetime == dtobject]
-            for alarm in alarms:
-                filtered_alarms_sorted.append(alarm)
-        return 0, filtered_alarms_sorted, {'future_part': future_part, 'time_part': time_part, 'room_part': room_part}
+        filtered_alarms = query(start=start, end=end, siteid=context_siteid)
+        return 0, filtered_alarms, {'future_part': future_part, 'time_part': time_part, 'room_part': room_part}
 
     def error_sentence(self, rc, words_dict=None):
         if rc == 1:
@@ -446,10 +482,10 @@ class AlarmClock:
             return self.translation.get("today")
         elif delta_days == 1:
             return self.translation.get("tomorrow")
-        elif delta_days == -1 and (alarm_time.date() - datetime.datetime.now().date()).days == 0:
+        elif delta_days == -1 and (alarm_time.date() - clock.now().date()).days == 0:
             delta_hours = (ftime.get_now_time() - alarm_time).seconds // 3600
             return self.translation.get("{delta_hours} hours ago", {'delta_hours': delta_hours})
-        elif delta_days == -1 and (alarm_time.date() - datetime.datetime.now().date()).days == -1:
+        elif delta_days == -1 and (alarm_time.date() - clock.now().date()).days == -1:
             return self.translation.get("yesterday")
         elif delta_days == 2:
             return self.translation.get("the day after tomorrow")
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import datetime
+import itertools                     # tie breaker for alarms with the same datetime
+import threading
+from . import clock
+
+
+class SortedAlarms:
+    def __init__(self, keys=(), alarms=()):
+
+        """
+        Immutable list of alarms sorted by their keys. Changes return a new object.
+        :param keys: Sorted tuple with (datetime, counter) keys
+        :param alarms: Tuple with the alarm objects in the same order
+        """
+
+        self.keys = keys
+        self.alarms = alarms
+
+    def __len__(self):
+        return len(self.keys)
+
+    def inserted(self, key, alarm):
+        index = bisect.bisect_right(self.keys, key)
+        return SortedAlarms(self.keys[:index] + (key,) + self.keys[index:],
+                            self.alarms[:index] + (alarm,) + self.alarms[index:])
+
+    def removed(self, key):
+        index = bisect.bisect_left(self.keys, key)
+        return SortedAlarms(self.keys[:index] + self.keys[index + 1:], self.alarms[:index] + self.alarms[index + 1:])
+
+    def changed(self, added, removed_keys):
+
+        """
+        Applies many changes at once in O((n + k) log(n + k)) instead of one copy per change.
+        :param added: List with (key, alarm) tuples
+        :param removed_keys: Set with the keys of the removed alarms
+        :return: SortedAlarms object
+        """
+
+        pairs = [pair for pair in zip(self.keys, self.alarms) if pair[0] not in removed_keys] + added
+        pairs.sort(key=lambda pair: pair[0])
+        return SortedAlarms(tuple(key for key, _ in pairs), tuple(alarm for _, alarm in pairs))
+
+    def range(self, start=None, end=None):
+        if start is None:
+            low = 0
+        else:
+            low = bisect.bisect_left(self.keys, (start,))
+        if end is None:
+            high = len(self.keys)
+        else:
+            high = bisect.bisect_right(self.keys, (end, float('inf')))
+        return list(self.alarms[low:high])
+
+
+EMPTY = SortedAlarms()
+
+
+class IndexSnapshot:
+    def __init__(self, all_alarms=EMPTY, sites=None):
+
+        """
+        Sorted alarms of an AlarmIndex at one point in time. It is never changed after it was created.
+        :param all_alarms: SortedAlarms object with all alarms
+        :param sites: Dictionary with siteId as key and a SortedAlarms object as value
+        """
+
+        self.all = all_alarms
+        self.sites = sites or {}
+
+
+class AlarmIndex:
+    def __init__(self, alarms=None):
+
+        """
+        Alarms sorted by their datetime with a second sorted partition for every siteId.
+        Range lookups cost O(log n + k). The datetime of an alarm must not change while it is indexed.
+        Writers are serialised and publish a new immutable snapshot (copy-on-write), which replaces the old
+        one with a single assignment. Readers never block and always see all or nothing of a change.
+        :param alarms: Iterable with alarm objects to fill the index with
+        """
+
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.snapshot = IndexSnapshot()
+        # alarm -> (key in the sorted lists, siteId), only changed by writers
+        self.keys = {}
+        self.update(added=alarms or [])
+
+    def __len__(self):
+        return len(self.snapshot.all)
+
+    def __iter__(self):
+        return iter(self.snapshot.all.alarms)
+
+    def __contains__(self, alarm):
+        return alarm in self.keys
+
+    def add(self, alarm):
+        with self.lock:
+            if alarm in self.keys:
+                return
+            snapshot = self.snapshot
+            key = (alarm.datetime, next(self.counter))
+            sites = dict(snapshot.sites)
+            sites[alarm.site.siteid] = sites.get(alarm.site.siteid, EMPTY).inserted(key, alarm)
+            self.snapshot = IndexSnapshot(snapshot.all.inserted(key, alarm), sites)
+            self.keys[alarm] = (key, alarm.site.siteid)
+
+    def remove(self, alarm):
+
+        """
+        Removes an alarm from the index.
+        :param alarm: Alarm object
+        :return: False if the alarm wasn't indexed (e.g. it was removed by another thread)
+        """
+
+        with self.lock:
+            if alarm not in self.keys:
+                return False
+            snapshot = self.snapshot
+            key, siteid = self.keys[alarm]
+            sites = dict(snapshot.sites)
+            sites[siteid] = sites[siteid].removed(key)
+            self.snapshot = IndexSnapshot(snapshot.all.removed(key), sites)
+            del self.keys[alarm]
+            return True
+
+    def update(self, added=(), removed=()):
+
+        """
+        Adds and removes many alarms with one new snapshot, so e.g. deleting several alarms is seen by
+        readers at once.
+        :param added: Iterable with alarm objects to add (alarms which are already indexed are skipped)
+        :param removed: Iterable with alarm objects to remove (alarms which aren't indexed are skipped)
+        :return: Nothing
+        """
+
+        with self.lock:
+            snapshot = self.snapshot
+            keys = self.keys
+            removed_keys = {}
+            for alarm in removed:
+                if alarm in keys:
+                    key, siteid = keys.pop(alarm)
+                    removed_keys.setdefault(siteid, set()).add(key)
+            added_pairs = {}
+            for alarm in added:
+                if alarm in keys:
+                    continue
+                key = (alarm.datetime, next(self.counter))
+                keys[alarm] = (key, alarm.site.siteid)
+                added_pairs.setdefault(alarm.site.siteid, []).append((key, alarm))
+            sites = dict(snapshot.sites)
+            for siteid in set(removed_keys) | set(added_pairs):
+                sites[siteid] = sites.get(siteid, EMPTY).changed(added_pairs.get(siteid, []),
+                                                                 removed_keys.get(siteid, set()))
+            all_removed_keys = set().union(*removed_keys.values())
+            all_added_pairs = [pair for pairs in added_pairs.values() for pair in pairs]
+            self.snapshot = IndexSnapshot(snapshot.all.changed(all_added_pairs, all_removed_keys), sites)
+
+    def first(self, siteid=None, skip=None):
+
+        """
+        Returns the earliest alarm without copying the index.
+        :param siteid: Only alarms of this site (optional)
+        :param skip: Function which returns True for alarms which should be skipped (optional)
+        :return: Alarm object or None
+        """
+
+        snapshot = self.snapshot
+        if siteid:
+            alarms = snapshot.sites.get(siteid, EMPTY).alarms
+        else:
+            alarms = snapshot.all.alarms
+        for alarm in alarms:
+            if not skip or not skip(alarm):
+                return alarm
+        return None
+
+    def range(self, start=None, end=None, siteid=None):
+
+        """
+        Returns the alarms between start and end (both inclusive), sorted by datetime.
+        :param start: Datetime object or None (no lower bound)
+        :param end: Datetime object or None (no upper bound)
+        :param siteid: Only return alarms of this site (optional)
+        :return: List with alarm objects
+        """
+
+        snapshot = self.snapshot
+        if siteid:
+            return snapshot.sites.get(siteid, EMPTY).range(start, end)
+        return snapshot.all.range(start, end)
+
+
+class MissedAlarmArchive(AlarmIndex):
+    def __init__(self, max_count=0, max_age=0, alarms=None):
+
+        """
+        Bounded index of the missed alarms. Every site keeps at most max_count missed alarms and none older
+        than max_age days, the oldest ones are dropped first (like a ring buffer), so missed alarms of rooms
+        nobody asks about can't grow without bound.
+        :param max_count: Maximum number of missed alarms per site (0: no limit)
+        :param max_age: Maximum age of a missed alarm in days (0: no limit)
+        :param alarms: Iterable with alarm objects to fill the archive with (call prune() afterwards)
+        """
+
+        self.max_count = max_count
+        self.max_age = max_age
+        super().__init__(alarms)
+
+    def prune(self, siteid=None):
+
+        """
+        Drops the oldest missed alarms of a site until the limits are met again.
+        :param siteid: Only prune this site (default: all sites)
+        :return: List with the dropped alarm objects
+        """
+
+        if self.max_age:
+            cutoff = clock.now() - datetime.timedelta(days=self.max_age)
+        else:
+            cutoff = None
+        snapshot = self.snapshot
+        dropped = []
+        for site_siteid in [siteid] if siteid else list(snapshot.sites):
+            alarms = snapshot.sites.get(site_siteid, EMPTY).alarms
+            index = 0
+            while index < len(alarms) and ((self.max_count and len(alarms) - index > self.max_count)
+                                           or (cutoff and alarms[index].datetime < cutoff)):
+                index += 1
+            dropped.extend(alarms[:index])
+        if dropped:
+            self.update(removed=dropped)
+        return dropped
+
+    def count(self):
+
+        """
+        Counts the missed alarms per site.
+        :return: Dictionary with siteId as key and the number of missed alarms as value
+        """
+
+        return {siteid: len(alarms) for siteid, alarms in self.snapshot.sites.items() if len(alarms)}
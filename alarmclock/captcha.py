@@ -2,7 +2,6 @@
 
 import random
 import formattime as ftime
-import datetime
 from translation import Translation
 
 
@@ -41,7 +40,7 @@ class Captcha:
             excercise = "Was ist {term} ?".format(term=term)
             return excercise, solution
         elif self.captcha_type == "clock":
-            now_time = datetime.datetime.now()
+            now_time = ftime.get_now_time()
             hours = ftime.get_alarm_hour(now_time)
             minutes = ftime.get_alarm_minute(now_time)
             solution = (hours, minutes)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import uuid
+
+CHANGES_TOPIC = 'external/alarmclock/changes'
+SNAPSHOT_TOPIC = 'external/alarmclock/snapshot'
+GET_SNAPSHOT_TOPIC = 'external/alarmclock/getSnapshot'
+
+
+class ChangeFeed:
+    def __init__(self, mqtt_client, get_snapshot):
+
+        """
+        Publishes every change of the alarms as a delta with a sequence number which increases by one per
+        message, so consumers only receive the changed alarms and can detect a lost message by a gap. After
+        a gap (or a different epoch, i.e. the app was restarted) they request a snapshot.
+        :param mqtt_client: MQTT client object (from paho)
+        :param get_snapshot: Function without parameters which returns a list with all alarm dictionaries
+        """
+
+        self.mqtt_client = mqtt_client
+        self.get_snapshot = get_snapshot
+        # the sequence numbers start again at every start of the app
+        self.epoch = str(uuid.uuid4())
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def publish(self, records):
+
+        """
+        Publishes changes on 'external/alarmclock/changes'.
+        :param records: List with records (see AlarmJournal.make_records)
+        :return: Sequence number of the message
+        """
+
+        changed = [record['alarm'] for record in records if record['op'] != 'delete']
+        deleted = [record['id'] for record in records if record['op'] == 'delete']
+        with self.lock:
+            self.seq += 1
+            self.mqtt_client.publish(CHANGES_TOPIC, json.dumps({'epoch': self.epoch, 'seq': self.seq,
+                                                                'changed': changed, 'deleted': deleted}))
+            return self.seq
+
+    def on_message_getsnapshot(self, client, userdata, msg):
+
+        """
+        Called when message 'external/alarmclock/getSnapshot' was received via MQTT. Publishes all alarms
+        with the sequence number of the last change on 'external/alarmclock/snapshot'.
+        :param client: MQTT client object (from paho)
+        :param userdata: MQTT userdata (from paho)
+        :param msg: MQTT message object (from paho)
+        :return: Nothing
+        """
+
+        with self.lock:
+            payload = json.dumps({'epoch': self.epoch, 'seq': self.seq, 'alarms': self.get_snapshot()})
+            self.mqtt_client.publish(SNAPSHOT_TOPIC, payload)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+
+
+class SystemClock:
+    simulated = False
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def register(self, timers):
+        pass
+
+
+class SimulatedClock(SystemClock):
+    simulated = True
+
+    def __init__(self, start=None):
+
+        """
+        Virtual clock which only moves with advance(). All timers of the registered timer services which
+        become due are called in order, so e.g. a week of alarms can be replayed in seconds.
+        :param start: Datetime object of the start (default: now)
+        """
+
+        self.current = start or datetime.datetime.now().replace(second=0, microsecond=0)
+        self.timer_services = []
+        self.lock = threading.RLock()
+
+    def now(self):
+        return self.current
+
+    def register(self, timers):
+        self.timer_services.append(timers)
+
+    def advance(self, seconds):
+
+        """
+        Fast-forwards the clock. The time jumps from deadline to deadline and the due timers are called
+        in the calling thread.
+        :param seconds: Seconds or timedelta object
+        :return: Nothing
+        """
+
+        if not isinstance(seconds, datetime.timedelta):
+            seconds = datetime.timedelta(seconds=seconds)
+        self.advance_to(self.current + seconds)
+
+    def advance_to(self, target):
+        with self.lock:
+            while True:
+                deadlines = [deadline for deadline in (timers.next_deadline() for timers in self.timer_services)
+                             if deadline is not None]
+                if not deadlines or min(deadlines) > target:
+                    break
+                self.current = max(self.current, min(deadlines))
+                for timers in self.timer_services:
+                    timers.run_pending()
+            self.current = target
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+
+    """
+    Sets the clock which is used by all modules (e.g. a SimulatedClock in benchmarks).
+    :param clock: SystemClock or SimulatedClock object
+    :return: Nothing
+    """
+
+    global _clock
+    _clock = clock
+
+
+def now():
+    return _clock.now()
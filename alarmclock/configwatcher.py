@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import os
+
+
+class ConfigWatcher:
+    def __init__(self, path, timers, interval, callback):
+
+        """
+        Checks the config file periodically in the timer service. The file is only read if its mtime or
+        size changed and the callback is only called if the content changed (SHA-1 checksum), so e.g.
+        touching the file does nothing.
+        :param path: Path of the config file
+        :param timers: TimerService object
+        :param interval: Seconds between two checks
+        :param callback: Function without parameters which is called when the content changed
+        """
+
+        self.path = path
+        self.timers = timers
+        self.interval = interval
+        self.callback = callback
+        self.stat = self._get_stat()
+        self.checksum = self._get_checksum()
+        self.timer = None
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _get_checksum(self):
+        try:
+            with io.open(self.path, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+
+    def start(self):
+        self.timer = self.timers.call_later(self.interval, self.check)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def set_interval(self, interval):
+
+        """
+        Changes the seconds between two checks (e.g. config_reload_interval was changed).
+        :param interval: Seconds between two checks (0: stop checking)
+        :return: Nothing
+        """
+
+        self.interval = interval
+        self.stop()
+        if interval:
+            self.start()
+
+    def check(self):
+
+        """
+        Called by the timer service. Calls the callback if the content of the config file changed and
+        schedules the next check.
+        :return: True if the config file changed
+        """
+
+        self.start()
+        stat = self._get_stat()
+        if stat is None or stat == self.stat:
+            return False
+        self.stat = stat
+        checksum = self._get_checksum()
+        if checksum == self.checksum:
+            return False
+        self.checksum = checksum
+        try:
+            self.callback()
+        except Exception as e:
+            print("Error while reloading the config: ", e)
+        return True
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+from . import clock
 
 
 def alarm_time_str(slots_time):
@@ -10,7 +11,7 @@ def alarm_time_str(slots_time):
 
 
 def get_now_time(only_date=False):
-    now = datetime.datetime.now()
+    now = clock.now()
     if only_date:
         now_time_str = "{0}-{1}-{2}".format(now.year, now.month, now.day)
         now_time = datetime.datetime.strptime(now_time_str, "%Y-%m-%d")
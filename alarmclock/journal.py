@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import time
+
+
+class AlarmJournal:
+    def __init__(self, path, fsync_policy="always", max_size=256):
+
+        """
+        Append-only log with one JSON record per line for every change of the alarms.
+        :param path: Path of the journal file
+        :param fsync_policy: 'always', 'never' or minimum number of seconds between two fsyncs
+        :param max_size: Size of the journal in KB after which it should be compacted into a snapshot
+        """
+
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.max_size = max_size * 1024
+        self.last_fsync = 0
+        # an append wasn't fsynced because of the interval, sync() must be called later (see sync_delay)
+        self.fsync_pending = False
+        # bytes appended since the start (for the metrics)
+        self.bytes_written = 0
+        # alarm dictionaries as they are on disk (snapshot + journal), compacted by get_alarms(). The live
+        # alarms can be ahead of them because of the changes which are still waiting for the writer.
+        self.alarms = {}
+
+    @staticmethod
+    def make_records(op, alarm_dicts):
+
+        """
+        Creates one journal record per alarm.
+        :param op: 'add' (also used for changed alarms) or 'delete'
+        :param alarm_dicts: List with alarm dictionaries (see Alarm.get_data_dict)
+        :return: List with records
+        """
+
+        if op == 'delete':
+            return [{'op': op, 'id': alarm_dict['id']} for alarm_dict in alarm_dicts]
+        return [{'op': op, 'alarm': alarm_dict} for alarm_dict in alarm_dicts]
+
+    def append(self, records):
+
+        """
+        Appends records (see make_records) to the journal with a single write.
+        :param records: List with records
+        :return: True if the journal has grown bigger than max_size and should be compacted
+        """
+
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        with io.open(self.path, "a") as f:
+            f.write(data)
+            f.flush()
+            if self._fsync_due():
+                self._fsync(f)
+            else:
+                self.fsync_pending = self.fsync_policy != "never"
+            size = f.tell()
+        self.bytes_written += len(data)
+        self._apply(records)
+        return size > self.max_size
+
+    def _apply(self, records):
+        for record in records:
+            if record['op'] == 'delete':
+                self.alarms.pop(record['id'], None)
+            else:
+                self.alarms[record['alarm']['id']] = record['alarm']
+
+    def _fsync(self, f):
+        os.fsync(f.fileno())
+        self.last_fsync = time.time()
+        self.fsync_pending = False
+
+    def sync_delay(self):
+
+        """
+        Returns when the deferred fsync of the last appends is due, so they aren't left unsynced if no
+        further append follows within the interval.
+        :return: Seconds until sync() should be called or None if nothing is pending
+        """
+
+        if not self.fsync_pending:
+            return None
+        return max(0, self.last_fsync + self.fsync_policy - time.time())
+
+    def sync(self):
+        if not self.fsync_pending:
+            return
+        # if the fsync fails it is tried again after the interval
+        self.last_fsync = time.time()
+        with io.open(self.path, "a") as f:
+            self._fsync(f)
+
+    def _fsync_due(self):
+        if self.fsync_policy == "always":
+            return True
+        elif self.fsync_policy == "never":
+            return False
+        return time.time() - self.last_fsync >= self.fsync_policy
+
+    def replay(self, alarm_dicts):
+
+        """
+        Applies the records of the journal to the alarms of a snapshot. A snapshot only contains the
+        journaled changes (see get_alarms), so replaying a journal which was not cleared after the last
+        snapshot (e.g. power loss) gives the same alarms.
+        :param alarm_dicts: List with alarm dictionaries from the snapshot
+        :return: List with alarm dictionaries
+        """
+
+        self.reset(alarm_dicts)
+        try:
+            with io.open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete last line after a crash
+                        continue
+                    self._apply([record])
+        except IOError:
+            pass
+        return list(self.alarms.values())
+
+    def reset(self, alarm_dicts):
+
+        """
+        Sets the alarms on disk, e.g. when they weren't restored from the snapshot and the journal.
+        :param alarm_dicts: List with alarm dictionaries
+        :return: Nothing
+        """
+
+        self.alarms = {alarm_dict['id']: alarm_dict for alarm_dict in alarm_dicts}
+
+    def get_alarms(self):
+
+        """
+        Returns the alarms for the compaction into a snapshot: only the changes which are already in the
+        journal, so the journal replayed after a crash before clear() never reverts newer changes.
+        Called by the writer thread.
+        :return: List with alarm dictionaries
+        """
+
+        return list(self.alarms.values())
+
+    def clear(self):
+        with io.open(self.path, "w"):
+            pass
+        self.fsync_pending = False
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+import time
+
+# upper bounds of the histogram buckets in milliseconds
+BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+# buckets for counts (e.g. how often the ringtone was played for one alarm)
+BUCKETS_COUNT = [1, 2, 3, 5, 10, 20, 50, 100]
+
+
+class Histogram:
+    def __init__(self, buckets=None):
+
+        """
+        Latency histogram with fixed buckets, so observing a value is O(log buckets) and needs no memory.
+        :param buckets: Sorted list with the upper bounds of the buckets (default: BUCKETS_MS)
+        """
+
+        self.buckets = buckets or BUCKETS_MS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+
+        """
+        Returns the upper bound of the bucket which contains the given percentile.
+        :param fraction: Percentile as fraction (e.g. 0.95)
+        :return: Upper bound of the bucket (max value for the last bucket) or None if empty
+        """
+
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def get_data_dict(self):
+        with self.lock:
+            return {'count': self.count,
+                    'sum': round(self.sum, 3),
+                    'max': round(self.max, 3),
+                    'p50': self.percentile(0.5),
+                    'p95': self.percentile(0.95),
+                    'p99': self.percentile(0.99),
+                    'buckets': {str(bound): count for bound, count in zip(self.buckets + ['inf'], self.counts)}}
+
+
+class Metrics:
+    def __init__(self):
+
+        """
+        Metrics of the alarm engine which are updated on the hot paths and published periodically
+        (see AlarmControl.publish_metrics). Times are in ms.
+        """
+
+        self.started = time.time()
+        self.scheduler_lag = Histogram()
+        self.timer_lag = Histogram()
+        self.write_duration = Histogram()
+        self.write_bytes = 0
+        self.writes = 0
+        self.write_errors = 0
+        self.ringing_loops = Histogram(BUCKETS_COUNT)
+        self.publishes = 0
+        self.publish_bytes = 0
+        self.handler_latency = Histogram()
+        self.lock = threading.Lock()
+
+    def observe_write(self, duration, written_bytes, failed=False):
+        with self.lock:
+            self.writes += 1
+            self.write_bytes += written_bytes
+            if failed:
+                self.write_errors += 1
+        self.write_duration.observe(duration)
+
+    def observe_publish(self, payload):
+        with self.lock:
+            self.publishes += 1
+            if payload:
+                self.publish_bytes += len(payload)
+
+    def get_data_dict(self):
+        with self.lock:
+            counters = {'writes': self.writes,
+                        'write_bytes': self.write_bytes,
+                        'write_errors': self.write_errors,
+                        'publishes': self.publishes,
+                        'publish_bytes': self.publish_bytes}
+        return dict(counters,
+                    uptime=round(time.time() - self.started),
+                    scheduler_lag=self.scheduler_lag.get_data_dict(),
+                    timer_lag=self.timer_lag.get_data_dict(),
+                    write_duration=self.write_duration.get_data_dict(),
+                    ringing_loops=self.ringing_loops.get_data_dict(),
+                    handler_latency=self.handler_latency.get_data_dict())
+
+
+class MeteredMqttClient:
+    def __init__(self, mqtt_client, metrics):
+
+        """
+        Wraps a paho client and counts the published messages and payload bytes.
+        :param mqtt_client: MQTT client object (from paho)
+        :param metrics: Metrics object
+        """
+
+        self.mqtt_client = mqtt_client
+        self.metrics = metrics
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.metrics.observe_publish(payload)
+        return self.mqtt_client.publish(topic, payload, qos, retain)
+
+    def __getattr__(self, name):
+        return getattr(self.mqtt_client, name)
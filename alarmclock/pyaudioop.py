@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Pure Python versions of the audioop functions used by the ringtone renderer. audioop was removed from the
+standard library in Python 3.13, this module is only used if neither it nor audioop-lts is installed.
+Samples are in native byte order like in audioop.
+"""
+
+import array
+import builtins                      # max() is shadowed by the audioop function of the same name
+
+SIGNED = {1: 'b', 2: 'h', 4: 'i'}
+UNSIGNED = {1: 'B', 2: 'H', 4: 'I'}
+
+
+def _samples(fragment, width, typecodes=SIGNED):
+    samples = array.array(typecodes[width])
+    samples.frombytes(bytes(fragment))
+    return samples
+
+
+def _clip(value, width):
+    limit = 1 << (width * 8 - 1)
+    return builtins.max(-limit, min(limit - 1, int(value)))
+
+
+def bias(fragment, width, bias_value):
+    mask = (1 << (width * 8)) - 1
+    samples = _samples(fragment, width, UNSIGNED)
+    return array.array(UNSIGNED[width], [(sample + bias_value) & mask for sample in samples]).tobytes()
+
+
+def max(fragment, width):
+    return builtins.max(map(abs, _samples(fragment, width)), default=0)
+
+
+def mul(fragment, width, factor):
+    return array.array(SIGNED[width], [_clip(sample * factor, width)
+                                       for sample in _samples(fragment, width)]).tobytes()
+
+
+def tomono(fragment, width, left_factor, right_factor):
+    samples = _samples(fragment, width)
+    return array.array(SIGNED[width], [_clip(left * left_factor + right * right_factor, width)
+                                       for left, right in zip(samples[::2], samples[1::2])]).tobytes()
+
+
+def tostereo(fragment, width, left_factor, right_factor):
+    stereo = array.array(SIGNED[width])
+    for sample in _samples(fragment, width):
+        stereo.append(_clip(sample * left_factor, width))
+        stereo.append(_clip(sample * right_factor, width))
+    return stereo.tobytes()
+
+
+def lin2lin(fragment, width, new_width):
+    shift = (new_width - width) * 8
+    samples = _samples(fragment, width)
+    if shift > 0:
+        converted = [sample << shift for sample in samples]
+    else:
+        converted = [sample >> -shift for sample in samples]
+    return array.array(SIGNED[new_width], converted).tobytes()
+
+
+def ratecv(fragment, width, channels, in_rate, out_rate, state):
+
+    """
+    Converts the frame rate with linear interpolation. Unlike audioop the state is not used, so the
+    fragment must be the whole recording.
+    :return: Tuple with the converted fragment and None (state)
+    """
+
+    samples = _samples(fragment, width)
+    frame_count = len(samples) // channels
+    out_count = frame_count * out_rate // in_rate
+    converted = array.array(SIGNED[width])
+    for index in range(out_count):
+        position = index * in_rate / out_rate
+        low = int(position)
+        high = low + 1 if low + 1 < frame_count else low
+        fraction = position - low
+        for channel in range(channels):
+            first = samples[low * channels + channel]
+            second = samples[high * channels + channel]
+            converted.append(_clip(first + (second - first) * fraction, width))
+    return converted.tobytes(), None
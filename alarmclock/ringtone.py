@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+try:
+    import audioop                   # sample math in C (peak, gain), audioop-lts on Python >= 3.13
+except ImportError:
+    from . import pyaudioop as audioop
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+import wave
+from collections import namedtuple
+
+SourceWav = namedtuple('SourceWav', ['digest', 'channels', 'sample_width', 'frame_rate', 'frames'])
+
+# encoding profiles: (frame rate, channels, sample width in bytes) - None keeps the format of the source
+PROFILES = {'native': None,
+            'mono_22k_16bit': (22050, 1, 2),
+            'mono_16k_16bit': (16000, 1, 2),
+            'mono_16k_8bit': (16000, 1, 1),
+            'mono_8k_8bit': (8000, 1, 1)}
+
+
+class RingtoneRenderer:
+    def __init__(self):
+
+        """
+        Renders ringtones with a certain volume and encoding profile directly into WAV bytes. Every
+        source file is decoded only once and rendered ringtones are cached by (source hash, volume,
+        loops, profile).
+        """
+
+        self.sources = {}
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_digest(wav_path):
+        with open(wav_path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def load_source(self, wav_path):
+        with self.lock:
+            if wav_path in self.sources:
+                return self.sources[wav_path]
+        with open(wav_path, "rb") as f:
+            wav_bytes = f.read()
+        with wave.open(io.BytesIO(wav_bytes), 'rb') as wave_data:
+            frames = wave_data.readframes(wave_data.getnframes())
+            if wave_data.getsampwidth() == 1:
+                # 8 bit WAV samples are unsigned, audioop works with signed samples
+                frames = audioop.bias(frames, 1, -128)
+            source = SourceWav(hashlib.sha1(wav_bytes).hexdigest(), wave_data.getnchannels(),
+                               wave_data.getsampwidth(), wave_data.getframerate(), frames)
+        with self.lock:
+            self.sources[wav_path] = source
+        return source
+
+    def render(self, wav_path, volume, loops=1, profile="native", cache=True):
+
+        """
+        Returns the ringtone normalised to 0 dBFS and then attenuated according to the volume.
+        :param wav_path: Path of the source WAV file
+        :param volume: Volume in percent (0 - 100)
+        :param loops: Number of times the ringtone is repeated in the WAV ("long render")
+        :param profile: Name of the encoding profile (see PROFILES)
+        :param cache: Whether the result should be kept in memory
+        :return: WAV file as bytes
+        """
+
+        source = self.load_source(wav_path)
+        key = (source.digest, volume, loops, profile)
+        with self.lock:
+            if key in self.rendered:
+                return self.rendered[key]
+        frame_rate, channels, sample_width, frames = self.convert(source, self.apply_volume(source, volume),
+                                                                  PROFILES[profile])
+        ringtone_wav = self.encode(frame_rate, channels, sample_width, frames * loops)
+        if cache:
+            with self.lock:
+                self.rendered[key] = ringtone_wav
+        return ringtone_wav
+
+    @staticmethod
+    def apply_volume(source, volume):
+        peak = audioop.max(source.frames, source.sample_width)
+        if not peak:
+            return source.frames
+        max_amplitude = 2 ** (source.sample_width * 8 - 1)
+        calc_volume = (100 - (volume * 0.8 + 20)) * 0.6  # attenuation in dB
+        factor = max_amplitude / peak * 10 ** (-calc_volume / 20)
+        return audioop.mul(source.frames, source.sample_width, factor)
+
+    @staticmethod
+    def convert(source, frames, profile):
+        if not profile:
+            return source.frame_rate, source.channels, source.sample_width, frames
+        frame_rate, channels, sample_width = profile
+        width = source.sample_width
+        if source.channels == 2 and channels == 1:
+            frames = audioop.tomono(frames, width, 0.5, 0.5)
+        elif source.channels == 1 and channels == 2:
+            frames = audioop.tostereo(frames, width, 1, 1)
+        if source.frame_rate != frame_rate:
+            frames = audioop.ratecv(frames, width, channels, source.frame_rate, frame_rate, None)[0]
+        if width != sample_width:
+            frames = audioop.lin2lin(frames, width, sample_width)
+        return frame_rate, channels, sample_width, frames
+
+    @staticmethod
+    def encode(frame_rate, channels, sample_width, frames):
+        if sample_width == 1:
+            frames = audioop.bias(frames, 1, 128)
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wave_data:
+            wave_data.setnchannels(channels)
+            wave_data.setsampwidth(sample_width)
+            wave_data.setframerate(frame_rate)
+            wave_data.writeframes(frames)
+        return buffer.getvalue()
+
+
+def split_wav(wav_bytes, chunk_size):
+
+    """
+    Splits a WAV file into several WAV files (each with its own header) of at most chunk_size bytes.
+    :param wav_bytes: WAV file as bytes
+    :param chunk_size: Maximum size of a chunk in bytes
+    :return: List with WAV files as bytes
+    """
+
+    with wave.open(io.BytesIO(wav_bytes), 'rb') as wave_data:
+        params = wave_data.getparams()
+        frame_size = params.nchannels * params.sampwidth
+        chunk_frames = max(1, (chunk_size - 44) // frame_size)  # 44 bytes: WAV header
+        chunks = []
+        while True:
+            frames = wave_data.readframes(chunk_frames)
+            if not frames:
+                break
+            buffer = io.BytesIO()
+            with wave.open(buffer, 'wb') as chunk:
+                chunk.setparams(params)
+                chunk.writeframes(frames)
+            chunks.append(buffer.getvalue())
+    return chunks
+
+
+class RingtoneStore:
+    def __init__(self, cache_dir, renderer=None):
+
+        """
+        Content-addressed store for rendered ringtones. Every variant is saved once as
+        <cache_dir>/<sha256>.wav and served as a read-only memory map, so sites with the same ringtone
+        share one buffer and restarts reuse the rendered files.
+        :param cache_dir: Directory for the rendered ringtones
+        :param renderer: RingtoneRenderer object (optional)
+        """
+
+        self.cache_dir = cache_dir
+        self.renderer = renderer or RingtoneRenderer()
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.maps = {}
+        self.chunks = {}
+        self.payloads = {}
+        self.digests = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with io.open(self.index_path, "r") as f:
+                # render key -> content hash
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def get(self, wav_path, volume, loops=1, profile="native"):
+
+        """
+        Returns the rendered ringtone as a read-only memory map. It is only rendered if there is no
+        file for this source file, volume, number of loops and encoding profile yet.
+        :param wav_path: Path of the source WAV file
+        :param volume: Volume in percent (0 - 100)
+        :param loops: Number of times the ringtone is repeated in the WAV
+        :param profile: Name of the encoding profile (see PROFILES)
+        :return: mmap object with the WAV file
+        """
+
+        return self.open(self.get_digest(wav_path, volume, loops, profile))
+
+    def get_payload(self, wav_path, volume, loops=1, profile="native"):
+
+        """
+        Returns the rendered ringtone as bytes for a MQTT payload (paho can't publish the memory map).
+        It is copied once and the same bytes object is shared by all sites and reused for every loop.
+        :param wav_path: Path of the source WAV file
+        :param volume: Volume in percent (0 - 100)
+        :param loops: Number of times the ringtone is repeated in the WAV
+        :param profile: Name of the encoding profile (see PROFILES)
+        :return: WAV file as bytes
+        """
+
+        digest = self.get_digest(wav_path, volume, loops, profile)
+        with self.lock:
+            if digest in self.payloads:
+                return self.payloads[digest]
+        payload = self.open(digest)[:]
+        with self.lock:
+            return self.payloads.setdefault(digest, payload)
+
+    def get_chunks(self, wav_path, volume, loops, profile, chunk_size):
+
+        """
+        Returns the rendered ringtone split into small WAV files. The list is shared by all sites
+        with the same ringtone and reused for every loop.
+        :param wav_path: Path of the source WAV file
+        :param volume: Volume in percent (0 - 100)
+        :param loops: Number of times the ringtone is repeated
+        :param profile: Name of the encoding profile (see PROFILES)
+        :param chunk_size: Maximum size of a chunk in bytes
+        :return: List with WAV files as bytes
+        """
+
+        digest = self.get_digest(wav_path, volume, loops, profile)
+        with self.lock:
+            if (digest, chunk_size) in self.chunks:
+                return self.chunks[(digest, chunk_size)]
+        chunks = split_wav(self.open(digest)[:], chunk_size)
+        with self.lock:
+            self.chunks[(digest, chunk_size)] = chunks
+        return chunks
+
+    def get_digest(self, wav_path, volume, loops=1, profile="native"):
+        if wav_path not in self.digests:
+            self.digests[wav_path] = self.renderer.get_digest(wav_path)
+        key = "{}-{}-{}-{}".format(self.digests[wav_path], volume, loops, profile)
+        with self.lock:
+            digest = self.index.get(key)
+        if not digest or not os.path.exists(self.get_path(digest)):
+            digest = self.put(self.renderer.render(wav_path, volume, loops, profile, cache=False))
+            with self.lock:
+                self.index[key] = digest
+                self._write_index()
+        return digest
+
+    def get_path(self, digest):
+        return os.path.join(self.cache_dir, digest + ".wav")
+
+    def put(self, wav_bytes):
+        digest = hashlib.sha256(wav_bytes).hexdigest()
+        path = self.get_path(digest)
+        if not os.path.exists(path):
+            temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(temp_path, "wb") as f:
+                f.write(wav_bytes)
+            os.replace(temp_path, path)
+        return digest
+
+    def open(self, digest):
+        with self.lock:
+            if digest not in self.maps:
+                with open(self.get_path(digest), "rb") as f:
+                    self.maps[digest] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.maps[digest]
+
+    def _write_index(self):
+        temp_path = self.index_path + ".tmp"
+        with io.open(temp_path, "w") as f:
+            f.write(json.dumps(self.index))
+        os.replace(temp_path, self.index_path)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+from . metrics import Histogram
+
+
+def get_slots(data):
+    slot_dict = {}
+    try:
+        for slot in data['slots']:
+            if slot['value']['kind'] in ["InstantTime", "TimeInterval", "Duration"]:
+                slot_dict[slot['slotName']] = slot['value']
+            elif slot['value']['kind'] == "Custom":
+                slot_dict[slot['slotName']] = slot['value']['value']
+    except (KeyError, TypeError, ValueError) as e:
+        print("Error: ", e)
+        slot_dict = {}
+    return slot_dict
+
+
+class IntentStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.decode = Histogram()
+        self.handler = Histogram()
+        self.publish = Histogram()
+
+    def get_data_dict(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'decode': self.decode.get_data_dict(),
+                'handler': self.handler.get_data_dict(),
+                'publish': self.publish.get_data_dict()}
+
+
+class IntentRouter:
+    def __init__(self, mqtt_client, prefix, metrics=None):
+
+        """
+        Dispatches intent messages with a dictionary lookup on the full intent name and records counts
+        and latency histograms (in ms) of the decode, handler and publish phase per intent.
+        :param mqtt_client: MQTT client object (from paho)
+        :param prefix: Username prefix of the intents (e.g. "domi")
+        :param metrics: Metrics object for the handler latency and published bytes (optional)
+        """
+
+        self.mqtt_client = mqtt_client
+        self.prefix = prefix
+        self.metrics = metrics
+        self.handlers = {}
+        self.stats = {}
+
+    def register(self, intent_name, handler):
+
+        """
+        Registers a handler for an intent.
+        :param intent_name: Intent name without prefix (e.g. "newAlarm")
+        :param handler: Function with the parameters (data, slots) which returns a list of
+                        (topic, payload dictionary) tuples to publish or None
+        :return: Nothing
+        """
+
+        full_name = "{}:{}".format(self.prefix, intent_name)
+        self.handlers[full_name] = handler
+        self.stats[full_name] = IntentStats()
+
+    def get_topics(self):
+        return ['hermes/intent/' + intent_id for intent_id in self.handlers]
+
+    def on_message_intent(self, client, userdata, msg):
+        start = time.perf_counter()
+        data = json.loads(msg.payload.decode("utf-8"))
+        intent_id = data['intent']['intentName']
+        handler = self.handlers.get(intent_id)
+        if not handler:
+            return
+        stats = self.stats[intent_id]
+        slots = get_slots(data)
+        decoded = time.perf_counter()
+        try:
+            messages = handler(data, slots)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.count += 1
+            handled = time.perf_counter()
+            stats.decode.observe((decoded - start) * 1000)
+            stats.handler.observe((handled - decoded) * 1000)
+        for topic, payload in messages or []:
+            payload = json.dumps(payload)
+            self.mqtt_client.publish(topic, payload)
+            if self.metrics:
+                self.metrics.observe_publish(payload)
+        stats.publish.observe((time.perf_counter() - handled) * 1000)
+        if self.metrics:
+            self.metrics.handler_latency.observe((handled - decoded) * 1000)
+
+    def get_stats(self):
+
+        """
+        Returns the statistics of all intents.
+        :return: Dictionary with intent name as key and the statistics dictionary as value
+        """
+
+        return {intent_id: stats.get_data_dict() for intent_id, stats in self.stats.items()}
+
+    def on_message_getstats(self, client, userdata, msg):
+
+        """
+        Called when message 'external/alarmclock/getIntentStats' was received via MQTT. Publishes the
+        statistics on 'external/alarmclock/intentStats'.
+        """
+
+        self.mqtt_client.publish('external/alarmclock/intentStats', json.dumps(self.get_stats()))
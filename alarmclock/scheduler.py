@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import functools
+import heapq
+import itertools                     # tie breaker for timers with the same datetime
+import threading
+from . import clock
+
+
+class Timer:
+    def __init__(self, service, when, function):
+        self.service = service
+        self.when = when
+        self.function = function
+        self.cancelled = False
+        # still in the queue of the service (also when cancelled)
+        self.queued = True
+
+    def cancel(self):
+
+        """
+        Cancels the timer in O(1) (amortised). It is only marked as cancelled and dropped when it reaches
+        the head of the queue or when cancelled timers make up more than half of the queue.
+        :return: Nothing
+        """
+
+        self.service.cancel(self)
+
+
+class TimerService:
+    def __init__(self, max_wait=60, clock_obj=None):
+
+        """
+        Priority queue of all deadlines (alarms, ringing timeouts, snoozes, session expiries) with a
+        single thread which sleeps until the next one is due.
+        :param max_wait: Maximum seconds to sleep at once (so system clock changes are noticed)
+        :param clock_obj: Clock object (default: clock of the clock module)
+        """
+
+        self.clock = clock_obj or clock.get_clock()
+        self.clock.register(self)
+        self.max_wait = max_wait
+        self.queue = []
+        # cancelled timers which are still in the queue
+        self.cancelled_count = 0
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def call_at(self, when, function):
+
+        """
+        Calls a function at a point in time.
+        :param when: Datetime object
+        :param function: Function without parameters
+        :return: Timer object with a cancel() method
+        """
+
+        timer = Timer(self, when, function)
+        with self.condition:
+            entry = (when, next(self.counter), timer)
+            heapq.heappush(self.queue, entry)
+            if self.queue[0] is entry:
+                # new head of the queue -> recalculate the sleep time
+                self._wake()
+        return timer
+
+    def call_later(self, seconds, function):
+        return self.call_at(self.clock.now() + datetime.timedelta(seconds=seconds), function)
+
+    def cancel(self, timer):
+        with self.condition:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            if not timer.queued:
+                return
+            self.cancelled_count += 1
+            if self.cancelled_count > len(self.queue) // 2:
+                self._compact()
+            elif self.queue[0][-1] is timer:
+                self._wake()
+
+    def _compact(self):
+        # drops all cancelled timers at once, so many cancelled far deadlines (e.g. snoozes) don't pile up
+        for entry in self.queue:
+            if entry[-1].cancelled:
+                entry[-1].queued = False
+        self.queue = [entry for entry in self.queue if not entry[-1].cancelled]
+        heapq.heapify(self.queue)
+        self.cancelled_count = 0
+        self._wake()
+
+    def _pop(self):
+        timer = heapq.heappop(self.queue)[-1]
+        timer.queued = False
+        if timer.cancelled:
+            self.cancelled_count -= 1
+        return timer
+
+    def pending(self):
+
+        """
+        Counts the timers which haven't been called or cancelled yet.
+        :return: Number of timers
+        """
+
+        with self.condition:
+            return len(self.queue) - self.cancelled_count
+
+    def _wake(self):
+        self.condition.notify()
+
+    def _pop_due(self):
+        now = self.clock.now()
+        due_timers = []
+        while self.queue and self.queue[0][0] <= now:
+            timer = self._pop()
+            if not timer.cancelled:
+                due_timers.append(timer)
+        return due_timers
+
+    def _next_deadline(self):
+        while self.queue and self.queue[0][-1].cancelled:
+            self._pop()
+        if not self.queue:
+            return None
+        return self.queue[0][0]
+
+    def _next_delay(self):
+        deadline = self._next_deadline()
+        if deadline is None or self.clock.simulated:
+            # a simulated clock calls run_pending() when it is advanced
+            return None
+        return min((deadline - self.clock.now()).total_seconds(), self.max_wait)
+
+    def next_deadline(self):
+        with self.condition:
+            return self._next_deadline()
+
+    def run_pending(self):
+
+        """
+        Calls the functions of all due timers in the calling thread (used by a simulated clock).
+        :return: Nothing
+        """
+
+        with self.condition:
+            due_timers = self._pop_due()
+        self._call(due_timers)
+
+    def _call(self, due_timers):
+        for timer in due_timers:
+            with self.condition:
+                # cancel() may have been called by another thread since the timer was popped
+                if timer.cancelled:
+                    continue
+                timer.cancelled = True
+            try:
+                timer.function()
+            except Exception as e:
+                print("Error in timer function: ", e)
+
+    def run(self):
+
+        """
+        Waits until the next timer is due and calls its function. Adding or cancelling timers wakes
+        up the thread early if the head of the queue has changed.
+        :return: Nothing
+        """
+
+        while True:
+            with self.condition:
+                due_timers = self._pop_due()
+                if not due_timers:
+                    self.condition.wait(self._next_delay())
+                    continue
+            self._call(due_timers)
+
+
+class AsyncTimerService(TimerService):
+    def __init__(self, loop, max_wait=60, clock_obj=None):
+
+        """
+        Same priority queue as TimerService, but driven by a timer of the asyncio event loop instead
+        of a thread. The functions are called in the event loop.
+        :param loop: asyncio event loop
+        :param max_wait: Maximum seconds to sleep at once (so system clock changes are noticed)
+        :param clock_obj: Clock object (default: clock of the clock module)
+        """
+
+        super().__init__(max_wait, clock_obj)
+        self.loop = loop
+        self.handle = None
+
+    def _wake(self):
+        self.loop.call_soon_threadsafe(self._check)
+
+    def start(self):
+        self._wake()
+
+    def _check(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        with self.condition:
+            due_timers = self._pop_due()
+            delay = self._next_delay()
+        self._call(due_timers)
+        if delay is not None:
+            self.handle = self.loop.call_later(max(delay, 0), self._check)
+
+
+class AlarmScheduler:
+    def __init__(self, callback, timers):
+
+        """
+        Keeps one timer per pending alarm in the timer service.
+        :param callback: Function which is called with the alarm object when it is due
+        :param timers: TimerService object
+        """
+
+        self.callback = callback
+        self.timers = timers
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, alarm):
+        with self.lock:
+            if alarm in self.entries:
+                self.entries.pop(alarm).cancel()
+            self.entries[alarm] = self.timers.call_at(alarm.datetime, functools.partial(self._due, alarm))
+
+    def remove(self, alarm):
+        with self.lock:
+            if alarm in self.entries:
+                self.entries.pop(alarm).cancel()
+
+    def _due(self, alarm):
+        with self.lock:
+            self.entries.pop(alarm, None)
+        self.callback(alarm)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alarms (
+    id TEXT PRIMARY KEY,
+    datetime TEXT NOT NULL,
+    siteid TEXT NOT NULL,
+    room TEXT,
+    repetition TEXT,
+    missed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS alarms_site_datetime ON alarms (siteid, datetime);
+CREATE INDEX IF NOT EXISTS alarms_missed_datetime ON alarms (missed, datetime);
+"""
+
+# journal_fsync policy -> synchronous mode of SQLite
+SYNCHRONOUS = {'always': "FULL", 'never': "OFF"}
+
+
+class SqliteAlarmStore:
+    def __init__(self, path, fsync_policy="always"):
+
+        """
+        Stores the alarms in a SQLite database. Every change is a transaction with one row per alarm,
+        so nothing has to be rewritten, and the missed alarms can stay on disk until they are queried.
+        Datetimes are stored as "%Y-%m-%d %H:%M" strings, which sort like the datetimes.
+        :param path: Path of the database file
+        :param fsync_policy: 'always', 'never' or seconds (see journal_fsync in the config)
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous={}".format(SYNCHRONOUS.get(fsync_policy, "NORMAL")))
+            self.connection.executescript(SCHEMA)
+        self.bytes_written = 0
+
+    @staticmethod
+    def _get_row(alarm_dict):
+        return (alarm_dict['id'], alarm_dict['datetime'], alarm_dict['siteid'], alarm_dict.get('room'),
+                json.dumps(alarm_dict.get('repetition')), int(bool(alarm_dict.get('missed'))))
+
+    @staticmethod
+    def _get_dict(row):
+        return {'id': row['id'],
+                'datetime': row['datetime'],
+                'siteid': row['siteid'],
+                'room': row['room'],
+                'repetition': json.loads(row['repetition']) if row['repetition'] else None,
+                'missed': bool(row['missed'])}
+
+    def append(self, records):
+
+        """
+        Applies records (see AlarmJournal.make_records) in one transaction.
+        :param records: List with records
+        :return: False (the store never needs a compaction)
+        """
+
+        try:
+            with self.lock, self.connection:
+                for record in records:
+                    if record['op'] == 'delete':
+                        self.connection.execute("DELETE FROM alarms WHERE id = ?", (record['id'],))
+                    else:
+                        self.connection.execute("INSERT OR REPLACE INTO alarms VALUES (?, ?, ?, ?, ?, ?)",
+                                                self._get_row(record['alarm']))
+        except sqlite3.Error as e:
+            # handled like a failed write of the journal (the writer tries again)
+            raise IOError(e)
+        self.bytes_written += len(json.dumps(records))
+        return False
+
+    @staticmethod
+    def sync_delay():
+        # SQLite syncs itself according to the synchronous mode
+        return None
+
+    def write_snapshot(self, alarm_dicts):
+
+        """
+        Writes the given alarms (e.g. alarms imported from an old JSON file). Alarms in the database
+        which are not in the list are kept, because the missed alarms are not held in memory.
+        :param alarm_dicts: List with alarm dictionaries (see Alarm.get_data_dict)
+        :return: Number of written bytes
+        """
+
+        self.append([{'op': 'add', 'alarm': alarm_dict} for alarm_dict in alarm_dicts])
+        return len(json.dumps(alarm_dicts))
+
+    @staticmethod
+    def _matches(alarm_dict, start, end, siteid, missed):
+        return ((missed is None or bool(alarm_dict.get('missed')) == missed)
+                and (siteid is None or alarm_dict['siteid'] == siteid)
+                and (start is None or alarm_dict['datetime'] >= start.strftime("%Y-%m-%d %H:%M"))
+                and (end is None or alarm_dict['datetime'] <= end.strftime("%Y-%m-%d %H:%M")))
+
+    @classmethod
+    def _apply_pending(cls, alarm_dicts, pending, start=None, end=None, siteid=None, missed=None):
+        alarms = {alarm_dict['id']: alarm_dict for alarm_dict in alarm_dicts}
+        for record in pending:
+            if record['op'] == 'delete':
+                alarms.pop(record['id'], None)
+            elif cls._matches(record['alarm'], start, end, siteid, missed):
+                alarms[record['alarm']['id']] = record['alarm']
+            else:
+                # e.g. the alarm was missed in the meantime
+                alarms.pop(record['alarm']['id'], None)
+        return sorted(alarms.values(), key=lambda alarm_dict: alarm_dict['datetime'])
+
+    def query(self, start=None, end=None, siteid=None, missed=None, pending=()):
+
+        """
+        Returns the alarms matching all given filters sorted by datetime.
+        :param start: Only alarms at or after this datetime
+        :param end: Only alarms at or before this datetime
+        :param siteid: Only alarms of this site
+        :param missed: Only missed (True) or live (False) alarms
+        :param pending: Records which aren't written yet (see PersistenceWriter.get_pending), they are
+                        applied to the result
+        :return: List with alarm dictionaries
+        """
+
+        conditions = []
+        parameters = []
+        if missed is not None:
+            conditions.append("missed = ?")
+            parameters.append(int(missed))
+        if siteid is not None:
+            conditions.append("siteid = ?")
+            parameters.append(siteid)
+        if start is not None:
+            conditions.append("datetime >= ?")
+            parameters.append(start.strftime("%Y-%m-%d %H:%M"))
+        if end is not None:
+            conditions.append("datetime <= ?")
+            parameters.append(end.strftime("%Y-%m-%d %H:%M"))
+        sql = "SELECT * FROM alarms"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            rows = self.connection.execute(sql + " ORDER BY datetime, rowid", parameters).fetchall()
+        alarm_dicts = [self._get_dict(row) for row in rows]
+        if pending:
+            return self._apply_pending(alarm_dicts, pending, start, end, siteid, missed)
+        return alarm_dicts
+
+    def count(self, missed=None, pending=()):
+
+        """
+        Counts the alarms per site.
+        :param missed: Only missed (True) or live (False) alarms
+        :param pending: Records which aren't written yet (see query)
+        :return: Dictionary with siteId as key and the number of alarms as value
+        """
+
+        if pending:
+            counts = {}
+            for alarm_dict in self.query(missed=missed, pending=pending):
+                counts[alarm_dict['siteid']] = counts.get(alarm_dict['siteid'], 0) + 1
+            return counts
+
+        sql = "SELECT siteid, COUNT(*) FROM alarms"
+        parameters = []
+        if missed is not None:
+            sql += " WHERE missed = ?"
+            parameters.append(int(missed))
+        with self.lock:
+            return dict(self.connection.execute(sql + " GROUP BY siteid", parameters).fetchall())
+
+    def get_missed_to_prune(self, max_count=0, before=None, pending=()):
+
+        """
+        Returns the oldest missed alarms of every site which exceed max_count and all missed alarms before
+        the given datetime. They are deleted with the next write (see AlarmControl.prune_missed).
+        :param max_count: Maximum number of missed alarms per site (0: no limit)
+        :param before: Datetime object or None (no age limit)
+        :param pending: Records which aren't written yet (see query)
+        :return: List with the ids of the alarms
+        """
+
+        if pending:
+            alarm_ids = []
+            by_site = {}
+            for alarm_dict in self.query(missed=True, pending=pending):
+                if before is not None and alarm_dict['datetime'] < before.strftime("%Y-%m-%d %H:%M"):
+                    alarm_ids.append(alarm_dict['id'])
+                by_site.setdefault(alarm_dict['siteid'], []).append(alarm_dict)
+            if max_count:
+                for alarm_dicts in by_site.values():
+                    # sorted by datetime, the oldest alarms are dropped
+                    alarm_ids += [alarm_dict['id'] for alarm_dict in alarm_dicts[:-max_count]]
+            return list(dict.fromkeys(alarm_ids))
+
+        with self.lock:
+            alarm_ids = []
+            if before is not None:
+                alarm_ids += [row[0] for row in self.connection.execute(
+                    "SELECT id FROM alarms WHERE missed = 1 AND datetime < ?", (before.strftime("%Y-%m-%d %H:%M"),))]
+            if max_count:
+                siteids = [row[0] for row in self.connection.execute(
+                    "SELECT siteid FROM alarms WHERE missed = 1 GROUP BY siteid HAVING COUNT(*) > ?", (max_count,))]
+                for siteid in siteids:
+                    alarm_ids += [row[0] for row in self.connection.execute(
+                        "SELECT id FROM alarms WHERE missed = 1 AND siteid = ? "
+                        "ORDER BY datetime DESC, rowid DESC LIMIT -1 OFFSET ?", (siteid, max_count))]
+        # an alarm can exceed both limits
+        return list(dict.fromkeys(alarm_ids))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
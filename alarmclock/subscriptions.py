@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from paho.mqtt.client import topic_matches_sub
+
+
+class SubscriptionManager:
+    def __init__(self, mqtt_client):
+
+        """
+        Keeps the MQTT subscriptions as narrow as possible. Topics are reference counted, so a topic
+        which is needed by several sites (e.g. while two rooms are ringing) is only unsubscribed when
+        no site needs it anymore.
+        :param mqtt_client: MQTT client object (from paho)
+        """
+
+        self.mqtt_client = mqtt_client
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, topic):
+        with self.lock:
+            self.counts[topic] = self.counts.get(topic, 0) + 1
+            if self.counts[topic] == 1:
+                self.mqtt_client.subscribe(topic)
+
+    def remove(self, topic):
+        with self.lock:
+            if topic not in self.counts:
+                return
+            self.counts[topic] -= 1
+            if self.counts[topic] == 0:
+                del self.counts[topic]
+                self.mqtt_client.unsubscribe(topic)
+
+    def resubscribe(self):
+
+        """
+        Subscribes all topics again (e.g. after a reconnect with a clean session).
+        :return: Nothing
+        """
+
+        with self.lock:
+            if self.counts:
+                self.mqtt_client.subscribe([(topic, 0) for topic in self.counts])
+
+    def is_subscribed(self, topic):
+        with self.lock:
+            if topic in self.counts:
+                return True
+            return any(topic_matches_sub(sub, topic) for sub in self.counts if '+' in sub or '#' in sub)
+
+    def route(self, pattern, handler):
+
+        """
+        Registers a callback for a topic pattern with a prefilter: messages on topics which are not
+        subscribed (anymore) are dropped before the handler decodes the payload.
+        :param pattern: Topic pattern (may contain wildcards)
+        :param handler: paho callback function (client, userdata, msg)
+        :return: Nothing
+        """
+
+        def prefiltered(client, userdata, msg):
+            if self.is_subscribed(msg.topic):
+                handler(client, userdata, msg)
+
+        self.mqtt_client.message_callback_add(pattern, prefiltered)
@@ -1,13 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from pydub import AudioSegment       # change volume of ringtone
 import re
 import configparser
 import io
-import wave
-import struct
-from collections import namedtuple
-from builtins import max as builtin_max
+from . ringtone import RingtoneRenderer, PROFILES
+
+_renderer = RingtoneRenderer()
 
 
 def read_configuration_file(configuration_file):
@@ -21,22 +19,34 @@ def read_configuration_file(configuration_file):
         return dict()
 
 
-def get_config(configuration_file, default_configuration_file):
+def get_config(configuration_file, default_configuration_file, strict=False):
+
+    """
+    Reads the config and replaces invalid values by their defaults.
+    :param configuration_file: Path of config.ini
+    :param default_configuration_file: Path of config.ini.default
+    :param strict: Raise a ValueError instead of falling back to the default rooms if dict_siteids is invalid
+                   (used when the config is reloaded, so a typo doesn't remove all rooms)
+    :return: Config dictionary
+    """
+
     config = read_configuration_file(configuration_file)
     default_config = read_configuration_file(default_configuration_file)
     output_dict = dict()
-    output_dict['dict_siteids'] = _get_dict_siteids(config, default_config)
-    del config['global']['dict_siteids']
-    for param in config['global'].keys():
-        user_value = config['global'][param].replace(" ", "")
+    output_dict['dict_siteids'] = _get_dict_siteids(config, default_config, strict)
+    for param in default_config['global'].keys():
+        if param == 'dict_siteids':
+            continue
         default_value = default_config['global'][param].replace(" ", "")
+        # parameters which are missing in the user config (e.g. added in a newer version) get the default value
+        user_value = config['global'].get(param, default_value).replace(" ", "")
         if ":" in user_value:
             pairs = user_value.split(",")
             output_dict[param] = {}
             for pair in pairs:
                 fvalue = _format_value(param, pair.split(":")[1], default_value)
                 output_dict[param][pair.split(":")[0]] = fvalue
-        elif param in ['ringing_volume', 'ringing_timeout', 'ringtone_status']:
+        elif param in ['ringing_volume', 'ringing_timeout', 'ringtone_status', 'ringtone_profile']:
             output_dict[param] = {output_dict['dict_siteids'][room]: _format_value(param, user_value, default_value)
                                   for room in output_dict['dict_siteids']}
         else:
@@ -44,12 +54,15 @@ def get_config(configuration_file, default_configuration_file):
     return output_dict
 
 
-def _get_dict_siteids(config, default_config):
+def _get_dict_siteids(config, default_config, strict=False):
     user_value = config['global']['dict_siteids'].replace(" ", "")
     default_value = default_config['global']['dict_siteids'].replace(" ", "")
-    if re.findall("^(\\w+)(:)(\\w+)(,(\\w+)(:)(\\w+))+$", user_value):
+    if re.findall("^(\\w+)(:)(\\w+)(,(\\w+)(:)(\\w+))*$", user_value):
         pairs = user_value
+    elif strict:
+        raise ValueError("Invalid value in parameter 'dict_siteids' of config, the old config is kept.")
     else:
+        print("Invalid value in parameter 'dict_siteids' of config. Set to default.")
         pairs = default_value
     fvalue = {}
     for pair in pairs.split(","):
@@ -83,6 +96,110 @@ def _format_value(param, user_value, default_value):
             fvalue = default_value
             set_default = True
 
+    elif param == 'alarms_storage':
+        if re.findall("^(snapshot|journal|sqlite)$", user_value.lower()):
+            fvalue = user_value.lower()
+        else:
+            fvalue = default_value.lower()
+            set_default = True
+
+    elif param == 'journal_fsync':
+        # 'always', 'never' or the minimum number of seconds between two fsyncs
+        if re.findall("^(always|never|[0-9]+)$", user_value.lower()):
+            value = user_value.lower()
+        else:
+            value = default_value.lower()
+            set_default = True
+        if value.isdigit():
+            fvalue = int(value)
+        else:
+            fvalue = value
+
+    elif param == 'journal_max_size':
+        # size in KB - min: 1 KB - max: 100000 KB
+        if re.findall("^([1-9][0-9]{0,4}|100000)$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
+    elif param == 'ringtone_profile':
+        if user_value.lower() in PROFILES:
+            fvalue = user_value.lower()
+        else:
+            fvalue = default_value.lower()
+            set_default = True
+
+    elif param == 'runtime':
+        if re.findall("^(threads|asyncio)$", user_value.lower()):
+            fvalue = user_value.lower()
+        else:
+            fvalue = default_value.lower()
+            set_default = True
+
+    elif param == 'ringtone_rendering':
+        if re.findall("^(startup|background|lazy)$", user_value.lower()):
+            fvalue = user_value.lower()
+        else:
+            fvalue = default_value.lower()
+            set_default = True
+
+    elif param == 'metrics_interval':
+        # seconds - 0: don't publish metrics
+        if re.findall("^([0-9]|[1-9][0-9]{1,3})$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
+    elif param == 'metrics_file':
+        # empty: don't write the metrics to a file
+        if re.findall("^([\\w./-]*)$", user_value):
+            fvalue = user_value
+        else:
+            fvalue = default_value
+            set_default = True
+
+    elif param == 'missed_alarms_max':
+        # missed alarms per site - 0: no limit
+        if re.findall("^([0-9]|[1-9][0-9]{1,3})$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
+    elif param == 'missed_alarms_max_age':
+        # days - 0: no limit
+        if re.findall("^([0-9]|[1-9][0-9]{1,3})$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
+    elif param == 'config_reload_interval':
+        # seconds - 0: the config is only read at startup
+        if re.findall("^([0-9]|[1-9][0-9]{1,3})$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
+    elif param == 'ringtone_chunk_size':
+        # size in KB - 0: send the ringtone in one piece
+        if re.findall("^([0-9]|[1-9][0-9]|[1-9][0-9][0-9])$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
+    elif param == 'ringtone_loops':
+        # min: 1 - max: 20
+        if re.findall("^([1-9]|1[0-9]|20)$", user_value):
+            fvalue = int(user_value)
+        else:
+            fvalue = int(default_value)
+            set_default = True
+
     elif param == 'ringtone_status' or 'restore_alarms':
         if re.findall("^(yes|[oa]n|true|ja|no|off|false|aus|nein)$", user_value.lower()):
             value = user_value.lower()
@@ -153,18 +270,12 @@ def _format_value(param, user_value, default_value):
 
 
 def edit_volume(wav_path, volume):
-    ringtone = AudioSegment.from_wav(wav_path)
-    ringtone -= ringtone.max_dBFS
-    calc_volume = (100 - (volume * 0.8 + 20)) * 0.6
-    ringtone -= calc_volume
-
-    with wave.open(".temporary_ringtone", 'wb') as wave_data:
-        wave_data.setnchannels(ringtone.channels)
-        wave_data.setsampwidth(ringtone.sample_width)
-        wave_data.setframerate(ringtone.frame_rate)
-        wave_data.setnframes(int(ringtone.frame_count()))
-        wave_data.writeframesraw(ringtone._data)
-
-    with open(".temporary_ringtone", "rb") as f:
-        ringtone_wav = f.read()
-    return ringtone_wav
+
+    """
+    Renders the ringtone with the given volume in memory (cached per source file and volume).
+    :param wav_path: Path of the source WAV file
+    :param volume: Volume in percent (0 - 100)
+    :return: WAV file as bytes
+    """
+
+    return _renderer.render(wav_path, volume)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+# longest pause between two attempts after write errors (e.g. full disk)
+MAX_RETRY_DELAY = 60
+
+
+class PersistenceWriter:
+    def __init__(self, write_snapshot, journal=None, delay=0.2, metrics=None):
+
+        """
+        Background thread which persists the alarms, so MQTT handlers never wait for the disk.
+        Changes arriving within 'delay' seconds are coalesced into a single write. If a write fails the
+        changes are kept and written again with exponential backoff.
+        :param write_snapshot: Function which writes all alarms to disk and returns the number of bytes
+        :param journal: AlarmJournal object (journal mode), SqliteAlarmStore object (sqlite mode) or None
+                        (snapshot mode)
+        :param delay: Seconds to wait for further changes before writing
+        :param metrics: Metrics object for the write durations and bytes (optional)
+        """
+
+        self.write_snapshot = write_snapshot
+        self.journal = journal
+        self.delay = delay
+        self.metrics = metrics
+        self.records = []
+        self.snapshot_due = False
+        self.requested = 0
+        self.written = 0
+        # write errors since the start and since the last successful write
+        self.errors = 0
+        self.failures = 0
+        # records which are being written at the moment (see get_pending)
+        self.writing = []
+        self.condition = threading.Condition()
+        self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, op, alarm_dicts):
+        self.extend(self.journal.make_records(op, alarm_dicts))
+
+    def extend(self, records):
+        with self.condition:
+            self.records.extend(records)
+            self._request()
+
+    def request_snapshot(self):
+        with self.condition:
+            self.snapshot_due = True
+            self._request()
+
+    def _request(self):
+        self.requested += 1
+        self.condition.notify_all()
+
+    def flush(self, timeout=None):
+
+        """
+        Barrier: blocks until every change requested before this call has been written or a write failed.
+        :param timeout: Maximum seconds to wait (None: wait forever)
+        :return: True if everything was written
+        """
+
+        with self.condition:
+            target = self.requested
+            errors = self.errors
+            self.condition.wait_for(lambda: self.written >= target or self.errors > errors, timeout)
+            return self.written >= target
+
+    def run(self):
+        while True:
+            with self.condition:
+                # also wakes up when the deferred fsync of the journal is due
+                changed = self.condition.wait_for(lambda: self.requested > self.written, self._sync_delay())
+            if not changed:
+                self.sync()
+                continue
+            # collect a burst of changes (or wait before the next attempt)
+            time.sleep(self._retry_delay())
+            self.write(*self._take())
+
+    def get_pending(self):
+
+        """
+        Returns the records which aren't written yet, so e.g. queries of the store can apply them to their
+        result instead of waiting for the writer.
+        :return: List with records in the order of the changes
+        """
+
+        with self.condition:
+            return self.writing + self.records
+
+    def _take(self):
+        with self.condition:
+            batch = (self.records, self.snapshot_due, self.requested)
+            self.writing = self.records
+            self.records = []
+            self.snapshot_due = False
+        return batch
+
+    def _retry_delay(self):
+        if not self.failures:
+            return self.delay
+        return min(self.delay * 2 ** self.failures, MAX_RETRY_DELAY)
+
+    def _sync_delay(self):
+        return self.journal.sync_delay() if self.journal else None
+
+    def sync(self):
+
+        """
+        Fsyncs the journal if appends weren't fsynced because of the journal_fsync interval.
+        Called by the writer when no further change arrived within the interval.
+        :return: Nothing
+        """
+
+        try:
+            self.journal.sync()
+        except (IOError, OSError) as e:
+            print("Error while saving alarms: ", e)
+
+    def write(self, records, snapshot_due, target):
+        start = time.perf_counter()
+        written_bytes = 0
+        failed = False
+        try:
+            if records:
+                journal_bytes = self.journal.bytes_written
+                if self.journal.append(records):
+                    snapshot_due = True
+                written_bytes += self.journal.bytes_written - journal_bytes
+                records = []
+            if snapshot_due:
+                written_bytes += self.write_snapshot()
+        except (IOError, OSError) as e:
+            print("Error while saving alarms: ", e)
+            failed = True
+        if self.metrics:
+            self.metrics.observe_write((time.perf_counter() - start) * 1000, written_bytes, failed)
+        with self.condition:
+            self.writing = []
+            if failed:
+                # put the changes back in front of the newer ones (replaying a record twice does no harm)
+                self.records = records + self.records
+                self.snapshot_due = self.snapshot_due or snapshot_due
+                self.errors += 1
+                self.failures += 1
+            else:
+                self.written = target
+                self.failures = 0
+            self.condition.notify_all()
+        return not failed
+
+
+class AsyncPersistenceWriter(PersistenceWriter):
+    def __init__(self, write_snapshot, journal=None, loop=None, delay=0.2, metrics=None):
+
+        """
+        Same coalescing as PersistenceWriter, but the bursts are collected by the asyncio event loop
+        and the writes run in its default executor, so no thread is kept waiting.
+        :param write_snapshot: Function which writes all alarms to disk and returns the number of bytes
+        :param journal: AlarmJournal object (journal mode), SqliteAlarmStore object (sqlite mode) or None
+                        (snapshot mode)
+        :param loop: asyncio event loop
+        :param delay: Seconds to wait for further changes before writing
+        :param metrics: Metrics object for the write durations and bytes (optional)
+        """
+
+        self.loop = loop
+        self.task = None
+        super().__init__(write_snapshot, journal, delay, metrics)
+
+    def start(self):
+        pass
+
+    def _request(self):
+        super()._request()
+        self.loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        if not self.task or self.task.done():
+            self.task = self.loop.create_task(self.run_async())
+
+    async def run_async(self):
+        while self.requested > self.written:
+            await asyncio.sleep(self._retry_delay())
+            if not await self.loop.run_in_executor(None, self.write, *self._take()):
+                # try again later, drain() doesn't wait for it
+                self.loop.call_later(self._retry_delay(), self._schedule)
+                return
+        sync_delay = self._sync_delay()
+        if sync_delay == 0:
+            await self.loop.run_in_executor(None, self.sync)
+        elif sync_delay is not None:
+            self.loop.call_later(sync_delay, self._schedule)
+
+    async def drain(self):
+
+        """
+        Barrier for coroutines in the event loop (flush() would block the loop).
+        :return: True if everything was written
+        """
+
+        while self.task and not self.task.done():
+            await asyncio.shield(self.task)
+        return self.written >= self.requested
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the alarm queries and the response rendering.
+
+Usage: python3 benchmarks/bench_alarmclock.py [--alarms 100,1000,10000] [--sites 10] [--output results.json]
+                                               [--compare old_results.json] [--threshold 1.5]
+
+Every benchmark is run for each alarm count, so a quadratic path shows up as a time per call which
+grows with the number of alarms. The results are written as JSON and can be compared with the results
+of another commit (--compare exits with status 1 if a benchmark got slower than the threshold).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from alarmclock import utils                        # noqa: E402
+from alarmclock.alarm import Alarm                  # noqa: E402
+from alarmclock.alarmclock import AlarmClock        # noqa: E402
+from alarmclock.ringtone import RingtoneRenderer    # noqa: E402
+from stubs import StubMqttClient, write_config, prepare_workdir  # noqa: E402
+
+
+def build_alarmclock(alarm_count, site_count, storage="snapshot"):
+
+    """
+    Creates an AlarmClock with a stub MQTT client and synthetic alarms which are spread over the sites
+    and the next weeks.
+    :param alarm_count: Number of alarms
+    :param site_count: Number of sites
+    :param storage: Value of the alarms_storage parameter
+    :return: AlarmClock object
+    """
+
+    write_config("config.ini", site_count, restore_alarms="off", ringtone_rendering="lazy", alarms_storage=storage)
+    config = utils.get_config("config.ini", "config.ini.default")
+    alarmclock = AlarmClock(StubMqttClient(), config=config)
+    sites = list(alarmclock.alarmctl.sites_dict.values())
+    start = datetime.datetime.now().replace(second=0, microsecond=0) + datetime.timedelta(hours=1)
+    for index in range(alarm_count):
+        alarm_time = start + datetime.timedelta(minutes=17 * index)
+        alarmclock.alarmctl.add(Alarm(alarm_time, sites[index % len(sites)]))
+    return alarmclock
+
+
+def time_slots(dtobj, grain="Day"):
+    return {'time': {'kind': "InstantTime", 'grain': grain,
+                     'value': dtobj.strftime("%Y-%m-%d %H:%M:00 +02:00")}}
+
+
+def interval_slots(from_dt, to_dt):
+    return {'time': {'kind': "TimeInterval",
+                     'from': from_dt.strftime("%Y-%m-%d %H:%M:00 +02:00"),
+                     'to': to_dt.strftime("%Y-%m-%d %H:%M:00 +02:00")}}
+
+
+def get_benchmarks(alarmclock):
+
+    """
+    Returns the benchmarks for an AlarmClock object.
+    :param alarmclock: AlarmClock object (see build_alarmclock)
+    :return: Dictionary with the name as key and a function without parameters as value
+    """
+
+    ctl = alarmclock.alarmctl
+    tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+    room_slots = dict(time_slots(tomorrow), room="Room0")
+    week_slots = interval_slots(tomorrow, tomorrow + datetime.timedelta(days=7))
+    rc, filtered_alarms, words_dict = alarmclock.filter_alarms(ctl.get_alarms, {}, "site0")
+    first_alarms = filtered_alarms[:5]
+    renderer = RingtoneRenderer()
+    return {
+        'filter_alarms/all': lambda: alarmclock.filter_alarms(ctl.get_alarms, {}, "site0"),
+        'filter_alarms/day_room': lambda: alarmclock.filter_alarms(ctl.get_alarms, room_slots, "site0"),
+        'filter_alarms/interval': lambda: alarmclock.filter_alarms(ctl.get_alarms, week_slots, "site0"),
+        'get_alarms': lambda: alarmclock.get_alarms({}, "site0"),
+        'get_alarms/day': lambda: alarmclock.get_alarms(time_slots(tomorrow), "site0"),
+        'get_next_alarm': lambda: alarmclock.get_next_alarm({}, "site0"),
+        'add_alarms_part': lambda: alarmclock.add_alarms_part("", "site0", first_alarms, words_dict,
+                                                              len(first_alarms)),
+        'get_time_description': lambda: alarmclock.get_time_description(tomorrow),
+        'save': ctl.write_snapshot,
+        'restore': ctl.restore,
+        'edit_volume': lambda: utils.edit_volume("alarm-sound.wav", 70),
+        'edit_volume/uncached': lambda: renderer.render("alarm-sound.wav", 70, cache=False),
+    }
+
+
+def measure(function, repeat):
+
+    """
+    Times a function with timeit (the number of calls per run is chosen automatically).
+    :param function: Function without parameters
+    :param repeat: Number of runs
+    :return: Dictionary with the best and the median time per call in microseconds
+    """
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [run / number * 1e6 for run in timer.repeat(repeat=repeat, number=number)]
+    return {'best_us': round(min(times), 3), 'median_us': round(statistics.median(times), 3), 'number': number}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results, threshold):
+
+    """
+    Prints the ratio of the new and the old time of every benchmark which exists in both results.
+    :param results: New results
+    :param old_results: Old results (e.g. of the parent commit)
+    :param threshold: Ratio above which a benchmark counts as regression
+    :return: List with the names of the regressions
+    """
+
+    regressions = []
+    for key, result in sorted(results['results'].items()):
+        if key not in old_results['results']:
+            continue
+        ratio = result['best_us'] / max(old_results['results'][key]['best_us'], 1e-9)
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = "  <-- regression"
+        print("{:45} {:>12.3f} us  x{:.2f}{}".format(key, result['best_us'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--alarms", default="100,1000,10000", help="Comma separated list of alarm counts")
+    parser.add_argument("--sites", type=int, default=10, help="Number of sites")
+    parser.add_argument("--storage", default="snapshot", help="alarms_storage (snapshot, journal or sqlite)")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs per benchmark")
+    parser.add_argument("--output", help="Path of the JSON file for the results (default: stdout)")
+    parser.add_argument("--compare", help="Path of older results to compare with")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Slowdown ratio which counts as regression")
+    args = parser.parse_args()
+
+    results = {'meta': {'commit': get_commit(),
+                        'python': platform.python_version(),
+                        'machine': platform.machine(),
+                        'sites': args.sites,
+                        'storage': args.storage,
+                        'date': datetime.datetime.now().isoformat()},
+               'results': {}}
+    workdir = tempfile.mkdtemp(prefix="alarmclock-bench-")
+    prepare_workdir(workdir, REPO_DIR)
+    os.chdir(workdir)
+    for alarm_count in [int(count) for count in args.alarms.split(",")]:
+        if os.path.exists(".saved_alarms.db"):
+            os.remove(".saved_alarms.db")
+        alarmclock = build_alarmclock(alarm_count, args.sites, args.storage)
+        for name, function in get_benchmarks(alarmclock).items():
+            key = "{}[alarms={}]".format(name, alarm_count)
+            results['results'][key] = measure(function, args.repeat)
+            print("{:45} {:>12.3f} us".format(key, results['results'][key]['best_us']), file=sys.stderr)
+        alarmclock.alarmctl.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)
+        if compare(results, old_results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+from paho.mqtt.client import topic_matches_sub
+
+
+class FakeMessage:
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class FakeBroker:
+    def __init__(self):
+
+        """
+        In-process MQTT broker for load tests. Messages are delivered in publish order by a single
+        thread, like the network thread of a paho client delivers them.
+        """
+
+        self.clients = []
+        self.retained = {}
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def client(self):
+        client = FakeMqttClient(self)
+        self.clients.append(client)
+        return client
+
+    def publish(self, message, receiver=None):
+        self.queue.put((message, receiver))
+
+    def run(self):
+        while True:
+            message, receiver = self.queue.get()
+            if message is None:
+                break
+            if receiver:
+                # retained message for a new subscription
+                receivers = [receiver]
+            else:
+                if message.retain:
+                    if message.payload:
+                        self.retained[message.topic] = message
+                    else:
+                        self.retained.pop(message.topic, None)
+                receivers = [client for client in self.clients if client.is_subscribed(message.topic)]
+            if not receivers:
+                self.dropped += 1
+            for client in receivers:
+                self.delivered += 1
+                try:
+                    client.deliver(message)
+                except Exception as e:
+                    self.errors += 1
+                    print("Error in callback for {}: {!r}".format(message.topic, e))
+            self.queue.task_done()
+
+    def join(self):
+
+        """
+        Blocks until all published messages (and the messages published while delivering them) are
+        delivered.
+        :return: Nothing
+        """
+
+        self.queue.join()
+
+    def stop(self):
+        self.stopped.set()
+        self.queue.put((None, None))
+
+
+class FakeMqttClient:
+    def __init__(self, broker):
+
+        """
+        Client with the interface of the paho client which is used by the skill.
+        :param broker: FakeBroker object
+        """
+
+        self.broker = broker
+        self.subscriptions = set()
+        self.callbacks = {}
+        self.on_connect = None
+        self.on_message = None
+        # asyncio event loop in which the callbacks are called (like with AsyncioMqttAdapter) or None
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host="localhost", port=1883, keepalive=60):
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+
+    def loop_forever(self):
+        self.broker.stopped.wait()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.broker.publish(FakeMessage(topic, bytes(payload or b""), qos, retain))
+
+    def subscribe(self, topic, qos=0):
+        topics = [sub for sub, _ in topic] if isinstance(topic, list) else [topic]
+        with self.lock:
+            self.subscriptions.update(topics)
+        for message in list(self.broker.retained.values()):
+            if any(topic_matches_sub(sub, message.topic) for sub in topics):
+                self.broker.publish(message, receiver=self)
+
+    def unsubscribe(self, topic):
+        with self.lock:
+            self.subscriptions.discard(topic)
+
+    def message_callback_add(self, sub, callback):
+        self.callbacks[sub] = callback
+
+    def message_callback_remove(self, sub):
+        self.callbacks.pop(sub, None)
+
+    def is_subscribed(self, topic):
+        with self.lock:
+            return any(topic_matches_sub(sub, topic) for sub in self.subscriptions)
+
+    def deliver(self, message):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.dispatch, message)
+        else:
+            self.dispatch(message)
+
+    def dispatch(self, message):
+        matched = False
+        for sub, callback in list(self.callbacks.items()):
+            if topic_matches_sub(sub, message.topic):
+                matched = True
+                callback(self, None, message)
+        if not matched and self.on_message:
+            self.on_message(self, None, message)
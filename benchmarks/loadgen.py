@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load generator which simulates Snips satellites against the skill.
+
+Usage: python3 benchmarks/loadgen.py [--sites 10] [--duration 30] [--intent-rate 0.5] [--audio-rate 10]
+                                      [--ring-alarms 1] [--runtime threads] [--output report.json]
+
+The skill (action-domi-Wecker.py) runs with an in-process fake broker. Every site sends intents with
+InstantTime and TimeInterval slots, ends its sessions, publishes audio frames in the background and
+answers ringing alarms with playFinished echoes, a hotword detection and a new session. The report
+contains the latency from an intent to its endSession/continueSession and the jitter of the ringing
+start (time of the first ringtone chunk minus the time of the alarm).
+"""
+
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from alarmclock import utils                    # noqa: E402
+from alarmclock.alarm import Alarm              # noqa: E402
+from alarmclock.metrics import Metrics          # noqa: E402
+from alarmclock.router import IntentRouter      # noqa: E402
+from alarmclock.scheduler import TimerService   # noqa: E402
+from fakebroker import FakeBroker               # noqa: E402
+from stubs import write_config, prepare_workdir  # noqa: E402
+
+# relative frequency of the intents
+INTENT_MIX = [("newAlarm", 3), ("getAlarms", 3), ("getNextAlarm", 3), ("getMissedAlarms", 1)]
+# size of an audio frame of a satellite (256 samples, 16 bit, 16 kHz, with WAV header)
+AUDIO_FRAME_SIZE = 556
+
+
+def load_skill():
+
+    """
+    Loads action-domi-Wecker.py as module (its main part is not executed).
+    :return: Module object
+    """
+
+    spec = importlib.util.spec_from_file_location("action_domi_wecker",
+                                                  os.path.join(REPO_DIR, "action-domi-Wecker.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def get(fraction):
+        return round(values[min(int(fraction * len(values)), len(values) - 1)], 3)
+
+    return {'count': len(values), 'p50': get(0.5), 'p90': get(0.9), 'p99': get(0.99),
+            'max': round(values[-1], 3)}
+
+
+def instant_slot(dtobj, grain="Minute"):
+    return {'slotName': "time", 'value': {'kind': "InstantTime", 'grain': grain,
+                                          'value': dtobj.strftime("%Y-%m-%d %H:%M:00 +02:00")}}
+
+
+def interval_slot(from_dt, to_dt):
+    return {'slotName': "time", 'value': {'kind': "TimeInterval",
+                                          'from': from_dt.strftime("%Y-%m-%d %H:%M:00 +02:00"),
+                                          'to': to_dt.strftime("%Y-%m-%d %H:%M:00 +02:00")}}
+
+
+class Satellite:
+    def __init__(self, broker, timers, siteid, room, report, play_time, chunks_before_hotword, session_delay):
+
+        """
+        Simulated satellite: answers ringtone chunks and stops the ringing with the hotword.
+        :param broker: FakeBroker object
+        :param timers: TimerService object for the simulated playing time
+        :param siteid: siteId of the satellite
+        :param room: Room name of the satellite
+        :param report: Report object
+        :param play_time: Seconds until a ringtone chunk is "played"
+        :param chunks_before_hotword: Number of played chunks after which the user says the hotword
+        :param session_delay: Seconds between the hotword and the sessionStarted message
+        """
+
+        self.siteid = siteid
+        self.room = room
+        self.report = report
+        self.timers = timers
+        self.play_time = play_time
+        self.chunks_before_hotword = chunks_before_hotword
+        self.session_delay = session_delay
+        self.played = 0
+        self.ringing_alarm_id = None
+        self.client = broker.client()
+        self.client.message_callback_add('hermes/dialogueManager/+', self.on_message_session)
+        self.client.message_callback_add('hermes/audioServer/{}/playBytes/#'.format(siteid), self.on_message_playbytes)
+        self.client.message_callback_add('external/alarmclock/ringingStarted', self.on_message_ringingstarted)
+        self.client.subscribe([('hermes/dialogueManager/endSession', 0),
+                               ('hermes/dialogueManager/continueSession', 0),
+                               ('hermes/dialogueManager/startSession', 0),
+                               ('hermes/audioServer/{}/playBytes/#'.format(siteid), 0),
+                               ('external/alarmclock/ringingStarted', 0)])
+
+    def publish(self, topic, data):
+        self.client.publish(topic, json.dumps(data))
+
+    def send_intent(self, intent_name, slots):
+        session_id = str(uuid.uuid4())
+        self.report.sessions[session_id] = (intent_name, time.perf_counter())
+        self.publish('hermes/intent/domi:' + intent_name,
+                     {'sessionId': session_id, 'siteId': self.siteid, 'customData': None, 'input': "",
+                      'intent': {'intentName': "domi:" + intent_name, 'probability': 1.0}, 'slots': slots})
+
+    def send_audio_frame(self):
+        self.client.publish('hermes/audioServer/{}/audioFrame'.format(self.siteid), bytes(AUDIO_FRAME_SIZE))
+
+    def on_message_session(self, client, userdata, msg):
+        data = json.loads(msg.payload.decode("utf-8"))
+        if msg.topic.endswith("startSession"):
+            if data.get('siteId') == self.siteid:
+                # answer of the snooze question
+                self.publish('hermes/dialogueManager/endSession', {'sessionId': data.get('sessionId', "")})
+            return
+        session = self.report.sessions.pop(data['sessionId'], None)
+        if not session:
+            return
+        intent_name, sent = session
+        self.report.latencies.setdefault(intent_name, []).append((time.perf_counter() - sent) * 1000)
+        self.publish('hermes/dialogueManager/sessionEnded',
+                     {'sessionId': data['sessionId'], 'siteId': self.siteid,
+                      'termination': {'reason': "nominal"}})
+
+    def on_message_ringingstarted(self, client, userdata, msg):
+        data = json.loads(msg.payload.decode("utf-8"))
+        if data['siteid'] == self.siteid:
+            self.ringing_alarm_id = data['id']
+            self.played = 0
+
+    def on_message_playbytes(self, client, userdata, msg):
+        ring_id = msg.topic.split("/")[-1]
+        if self.ringing_alarm_id:
+            planned = self.report.planned_alarms.pop(self.ringing_alarm_id, None)
+            if planned:
+                self.report.jitter.append((datetime.datetime.now() - planned).total_seconds() * 1000)
+        self.timers.call_later(self.play_time, lambda: self.on_played(ring_id))
+
+    def on_played(self, ring_id):
+        self.publish('hermes/audioServer/{}/playFinished'.format(self.siteid), {'id': ring_id, 'siteId': self.siteid})
+        if not self.ringing_alarm_id:
+            return
+        self.played += 1
+        if self.played == self.chunks_before_hotword:
+            self.ringing_alarm_id = None
+            self.publish('hermes/hotword/{}/detected'.format(self.siteid),
+                         {'siteId': self.siteid, 'modelId': "hey_snips"})
+            # the dialogue manager starts the session a moment after the hotword
+            self.timers.call_later(self.session_delay, self.start_session)
+
+    def start_session(self):
+        session_id = str(uuid.uuid4())
+        self.report.sessions[session_id] = ("sessionStarted", time.perf_counter())
+        self.publish('hermes/dialogueManager/sessionStarted', {'siteId': self.siteid, 'sessionId': session_id})
+
+
+class Report:
+    def __init__(self):
+        self.sessions = {}
+        self.latencies = {}
+        self.jitter = []
+        self.planned_alarms = {}
+
+
+def make_events(satellites, duration, intent_rate, audio_rate):
+
+    """
+    Creates the schedule of the load (Poisson distributed intents, periodic audio frames).
+    :return: List of (seconds after start, function) tuples sorted by time
+    """
+
+    names = [name for name, weight in INTENT_MIX for _ in range(weight)]
+    events = []
+    for satellite in satellites:
+        offset = 0.0
+        while intent_rate:
+            offset += random.expovariate(intent_rate)
+            if offset >= duration:
+                break
+            events.append((offset, satellite, random.choice(names)))
+        if audio_rate:
+            start = random.random() / audio_rate
+            events += [(start + index / audio_rate, satellite, None) for index in range(int(duration * audio_rate))]
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def get_slots(intent_name, satellites, now):
+    if intent_name == "newAlarm":
+        return [instant_slot(now + datetime.timedelta(minutes=random.randint(5, 7 * 24 * 60)))]
+    slots = []
+    choice = random.random()
+    if choice < 0.3:
+        slots.append(instant_slot(now + datetime.timedelta(days=random.randint(0, 6)), grain="Day"))
+    elif choice < 0.6:
+        slots.append(interval_slot(now, now + datetime.timedelta(days=random.randint(1, 6))))
+    if random.random() < 0.3:
+        slots.append({'slotName': "room", 'value': {'kind': "Custom", 'value': random.choice(satellites).room}})
+    return slots
+
+
+def start_skill(skill, broker, config, runtime):
+
+    """
+    Starts the skill like its main part does, but with a client of the fake broker.
+    :return: Nothing
+    """
+
+    skill.mqtt_client = broker.client()
+    skill.metrics = Metrics()
+    skill.intent_router = IntentRouter(skill.mqtt_client, skill.USERNAME_INTENTS, skill.metrics)
+    skill.register_intents(skill.intent_router)
+    skill.mqtt_client.message_callback_add('external/alarmclock/getIntentStats',
+                                           skill.intent_router.on_message_getstats)
+    ready = threading.Event()
+
+    def on_ready(client, userdata, msg):
+        ready.set()
+
+    observer = broker.client()
+    observer.message_callback_add('external/alarmclock/ready', on_ready)
+    observer.subscribe('external/alarmclock/ready')
+    if runtime == "asyncio":
+        loop = asyncio.new_event_loop()
+        skill.mqtt_client.loop = loop
+        thread = threading.Thread(target=loop.run_until_complete, args=(skill.main_asyncio(config),), daemon=True)
+    else:
+        thread = threading.Thread(target=skill.main_threads, args=(config,), daemon=True)
+    thread.start()
+    ready.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sites", type=int, default=10, help="Number of simulated satellites")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--intent-rate", type=float, default=0.5, help="Intents per second and site")
+    parser.add_argument("--audio-rate", type=float, default=10, help="Audio frames per second and site")
+    parser.add_argument("--ring-alarms", type=int, default=1, help="Ringing alarms per site during the load")
+    parser.add_argument("--play-time", type=float, default=0.5, help="Seconds a ringtone chunk plays")
+    parser.add_argument("--hotword-after", type=int, default=2, help="Played chunks until the hotword is said")
+    parser.add_argument("--session-delay", type=float, default=0.2, help="Seconds from hotword to sessionStarted")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Path of the JSON file for the report (default: stdout)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="alarmclock-load-")
+    prepare_workdir(workdir, REPO_DIR)
+    os.chdir(workdir)
+    write_config("config.ini", args.sites, restore_alarms="off", runtime=args.runtime)
+    config = utils.get_config("config.ini", "config.ini.default")
+
+    broker = FakeBroker()
+    timers = TimerService()
+    threading.Thread(target=timers.run, daemon=True).start()
+    skill = load_skill()
+    start_skill(skill, broker, config, args.runtime)
+    report = Report()
+    satellites = [Satellite(broker, timers, siteid, room, report, args.play_time, args.hotword_after,
+                            args.session_delay)
+                  for room, siteid in config['dict_siteids'].items()][:args.sites]
+
+    # alarms which ring during the load (added directly, the intents only accept alarms in 2 minutes or later)
+    alarmctl = skill.alarmclock.alarmctl
+    start = datetime.datetime.now()
+    for satellite in satellites:
+        for _ in range(args.ring_alarms):
+            alarm_time = start + datetime.timedelta(seconds=random.uniform(1, args.duration * 0.7))
+            alarm = Alarm(alarm_time, alarmctl.sites_dict[satellite.siteid])
+            report.planned_alarms[alarm.id] = alarm_time
+            alarmctl.add(alarm)
+
+    started = time.perf_counter()
+    for offset, satellite, intent_name in make_events(satellites, args.duration, args.intent_rate, args.audio_rate):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if intent_name:
+            satellite.send_intent(intent_name, get_slots(intent_name, satellites, datetime.datetime.now()))
+        else:
+            satellite.send_audio_frame()
+    elapsed = time.perf_counter() - started
+    # let the last sessions finish
+    time.sleep(2)
+    broker.join()
+
+    results = {'meta': {'sites': args.sites, 'duration': args.duration, 'intent_rate': args.intent_rate,
+                        'audio_rate': args.audio_rate, 'runtime': args.runtime, 'elapsed': round(elapsed, 3)},
+               'latency_ms': {name: percentiles(values) for name, values in sorted(report.latencies.items())},
+               'latency_ms_all_intents': percentiles([value for name, values in report.latencies.items()
+                                                      for value in values if name != "sessionStarted"]),
+               'ringing_jitter_ms': percentiles(report.jitter),
+               'unanswered_sessions': [name for name, _ in report.sessions.values()],
+               'alarms_not_rung': len(report.planned_alarms),
+               'broker': {'delivered': broker.delivered, 'dropped': broker.dropped, 'errors': broker.errors},
+               'intent_errors': {name: stats['errors'] for name, stats in skill.intent_router.get_stats().items()
+                                 if stats['errors']}}
+    broker.stop()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Replays days of alarms with a simulated clock.
+
+Usage: python3 benchmarks/simulate.py [--days 7] [--sites 10] [--alarms-per-day 3] [--output report.json]
+
+Every ringing alarm is stopped with the hotword, snoozed or left ringing until the ringing timeout
+(then it is a missed alarm). Once a day every site asks for its missed alarms. The clock jumps from
+deadline to deadline, so a week takes seconds instead of a week.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from alarmclock import utils                    # noqa: E402
+from alarmclock.alarm import Alarm              # noqa: E402
+from alarmclock.alarmclock import AlarmClock    # noqa: E402
+from alarmclock.clock import SimulatedClock     # noqa: E402
+from fakebroker import FakeMessage              # noqa: E402
+from stubs import StubMqttClient, write_config, prepare_workdir  # noqa: E402
+
+
+class RecordingClient(StubMqttClient):
+    def __init__(self):
+        super().__init__()
+        self.ringing_sites = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        super().publish(topic, payload, qos, retain)
+        if topic == 'external/alarmclock/ringingStarted':
+            self.ringing_sites.append(json.loads(payload)['siteid'])
+
+
+def message(topic, data):
+    return FakeMessage(topic, json.dumps(data).encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--days", type=int, default=7, help="Simulated days")
+    parser.add_argument("--sites", type=int, default=10, help="Number of sites")
+    parser.add_argument("--alarms-per-day", type=int, default=3, help="Alarms per day and site")
+    parser.add_argument("--snooze", type=float, default=0.25, help="Probability that a ringing alarm is snoozed")
+    parser.add_argument("--ignore", type=float, default=0.25, help="Probability that a ringing alarm is missed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Path of the JSON file for the report (default: stdout)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="alarmclock-sim-")
+    prepare_workdir(workdir, REPO_DIR)
+    os.chdir(workdir)
+    write_config("config.ini", args.sites, restore_alarms="off", ringtone_rendering="lazy")
+    config = utils.get_config("config.ini", "config.ini.default")
+    clock = SimulatedClock()
+    client = RecordingClient()
+    alarmclock = AlarmClock(client, config=config, clock_obj=clock)
+    alarmctl = alarmclock.alarmctl
+    sites = list(alarmctl.sites_dict.values())[:args.sites]
+    start = clock.now()
+    for site in sites:
+        for _ in range(args.days * args.alarms_per_day):
+            alarmctl.add(Alarm(start + datetime.timedelta(minutes=random.randint(2, args.days * 24 * 60)), site))
+
+    counts = {'alarms': len(alarmctl.alarms), 'rung': 0, 'stopped': 0, 'snoozed': 0, 'ignored': 0,
+              'missed_reported': 0}
+    started = time.perf_counter()
+    for minute in range(args.days * 24 * 60):
+        clock.advance(60)
+        while client.ringing_sites:
+            site = alarmctl.sites_dict[client.ringing_sites.pop(0)]
+            counts['rung'] += 1
+            choice = random.random()
+            if choice < args.ignore:
+                # rings until the ringing timeout
+                counts['ignored'] += 1
+                continue
+            alarmctl.on_message_hotword(client, None, message('hermes/hotword/{}/detected'.format(site.siteid),
+                                                              {'siteId': site.siteid}))
+            alarmctl.on_message_sessionstarted(client, None, message('hermes/dialogueManager/sessionStarted',
+                                                                     {'siteId': site.siteid, 'sessionId': "s"}))
+            if choice < args.ignore + args.snooze:
+                counts['snoozed'] += 1
+                alarmctl.snooze(Alarm(clock.now() + datetime.timedelta(minutes=9), site))
+            else:
+                counts['stopped'] += 1
+        if minute % (24 * 60) == 24 * 60 - 1:
+            missed = len(alarmctl.missed_alarms)
+            for site in sites:
+                alarmclock.get_missed_alarms({}, site.siteid)
+            counts['missed_reported'] += missed - len(alarmctl.missed_alarms)
+    elapsed = time.perf_counter() - started
+    alarmctl.flush()
+
+    results = {'meta': {'days': args.days, 'sites': args.sites, 'alarms_per_day': args.alarms_per_day},
+               'elapsed_s': round(elapsed, 3),
+               'speedup': round(args.days * 24 * 3600 / elapsed),
+               'counts': counts,
+               'pending_alarms': len(alarmctl.alarms),
+               'published_messages': client.published}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+
+
+class StubMqttClient:
+    def __init__(self):
+
+        """
+        MQTT client with the interface of the paho client which only counts the published messages,
+        so the benchmarks measure the skill and not the network.
+        """
+
+        self.published = 0
+        self.published_bytes = 0
+        self.callbacks = {}
+        self.subscriptions = set()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        if payload:
+            self.published_bytes += len(payload)
+
+    def subscribe(self, topic, qos=0):
+        if isinstance(topic, list):
+            self.subscriptions.update(sub for sub, _ in topic)
+        else:
+            self.subscriptions.add(topic)
+
+    def unsubscribe(self, topic):
+        self.subscriptions.discard(topic)
+
+    def message_callback_add(self, sub, callback):
+        self.callbacks[sub] = callback
+
+    def message_callback_remove(self, sub):
+        self.callbacks.pop(sub, None)
+
+
+def write_config(path, site_count, **options):
+
+    """
+    Writes a config.ini with synthetic rooms ("Room0:site0,Room1:site1,...").
+    :param path: Path of the config file
+    :param site_count: Number of sites
+    :param options: Further parameters of the [global] section
+    :return: Nothing
+    """
+
+    rooms = ["Room{0}:site{0}".format(index) for index in range(site_count)]
+    if len(rooms) == 1:
+        # the config parser only accepts lists with several rooms
+        rooms.append("Room1:site1")
+    lines = ["[global]",
+             "dict_siteids={}".format(",".join(rooms)),
+             "default_room=Room0"]
+    lines += ["{}={}".format(param, value) for param, value in options.items()]
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines + ["[secret]", ""]))
+
+
+def prepare_workdir(workdir, repo_dir):
+
+    """
+    Creates a working directory with the files the skill expects in its current directory.
+    :param workdir: Path of the working directory
+    :param repo_dir: Path of the repository
+    :return: Nothing
+    """
+
+    os.makedirs(workdir, exist_ok=True)
+    for name in ["config.ini.default", "alarm-sound.wav"]:
+        with io.open(os.path.join(repo_dir, name), "rb") as src, io.open(os.path.join(workdir, name), "wb") as dst:
+            dst.write(src.read())
+    io.open(os.path.join(workdir, ".saved_alarms.json"), "a").close()
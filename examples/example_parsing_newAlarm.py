@@ -12,8 +12,7 @@ def on_message(client, userdata, msg):
     dt = datetime.datetime
     # parsing of string to datetime object
     dt_newalarm = dt.strptime(data['new']['datetime'], "%Y-%m-%d %H:%M")
-    # dictionary with all alarms
-    alarms_dict = {dt.strptime(dtstr, "%Y-%m-%d %H:%M"): data['all'][dtstr] for dtstr in data['all']}
+    # all alarms can be followed with the topics 'external/alarmclock/changes' and 'external/alarmclock/snapshot'
     # [...]
 
 
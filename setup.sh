@@ -38,7 +38,3 @@ fi
 if [ ! -e ./.saved_alarms.json ]; then
     touch .saved_alarms.json
 fi
-
-if [ ! -e ./.temporary_ringtone ]; then
-    touch .temporary_ringtone
-fi